@@ -1,10 +1,21 @@
 import os
+import sys
+import math
+import time
+import json
 import asyncio
+import hashlib
+import pathlib
+import signal
 import discord
 from discord.ext import commands
 from dotenv import load_dotenv
 import aiomysql
 
+from utils.db import InstrumentedPool, ReplicaPool
+from utils.members import member_cache
+from utils.metrics import MetricsCommandTree, metrics, probe_loop_lag, start_metrics_server
+
 # ENV
 load_dotenv()
 TOKEN = os.getenv("DISCORD_TOKEN")
@@ -14,6 +25,54 @@ DB_PORT = int(os.getenv("DB_PORT", "3306"))
 DB_NAME = os.getenv("DB_NAME")
 DB_USER = os.getenv("DB_USER")
 DB_PASS = os.getenv("DB_PASS")
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "10"))
+DB_CONNECT_TIMEOUT = float(os.getenv("DB_CONNECT_TIMEOUT", "10"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "3600"))     # Sekunden; -1 = nie recyceln
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "30"))   # Sekunden pro Statement; 0 = aus
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "500"))
+DB_STATS_LOG_SECONDS = int(os.getenv("DB_STATS_LOG_SECONDS", "600"))  # 0 = keine periodische Pool-Statistik
+
+# Optionale Lese-Replica (Rangliste, /level). Ohne DB_READ_HOST lesen alle Cogs vom Primary.
+DB_READ_HOST = os.getenv("DB_READ_HOST")
+DB_READ_PORT = int(os.getenv("DB_READ_PORT", str(DB_PORT)))
+DB_READ_NAME = os.getenv("DB_READ_NAME", DB_NAME)
+DB_READ_USER = os.getenv("DB_READ_USER", DB_USER)
+DB_READ_PASS = os.getenv("DB_READ_PASS", DB_PASS)
+DB_READ_MAX_LAG_SECONDS = float(os.getenv("DB_READ_MAX_LAG_SECONDS", "5"))
+DB_READ_CHECK_SECONDS = float(os.getenv("DB_READ_CHECK_SECONDS", "15"))
+FORCE_COMMAND_SYNC = os.getenv("FORCE_COMMAND_SYNC", "0") == "1"
+
+# Sharding / Cluster (opt-in). Ohne SHARDING=1 läuft alles wie bisher in einem Bot ohne Shards.
+SHARDING = os.getenv("SHARDING", "0") == "1"
+SHARD_COUNT = int(os.getenv("SHARD_COUNT")) if os.getenv("SHARD_COUNT") else None  # None: von Discord empfohlen
+SHARD_IDS = [int(i) for i in os.getenv("SHARD_IDS").split(",")] if os.getenv("SHARD_IDS") else None
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", "0"))  # wird vom launcher.py pro Prozess gesetzt
+if SHARD_IDS is not None and (SHARD_COUNT is None or any(not 0 <= i < SHARD_COUNT for i in SHARD_IDS)):
+    # AutoShardedBot lehnt shard_ids ohne (passenden) shard_count erst beim Start ab -> hier klar melden
+    sys.exit(f"SHARD_IDS ({os.getenv('SHARD_IDS')}) braucht SHARD_COUNT, und alle IDs müssen kleiner als SHARD_COUNT sein.")
+
+# Schlanker Member-Cache: nur Voice-Mitglieder im Gateway-Cache, kein Chunking beim Start,
+# alle anderen Mitglieder lazy über den geteilten LRU in utils/members.py
+LEAN_MEMBER_CACHE = os.getenv("LEAN_MEMBER_CACHE", "0") == "1"
+
+# Metrik-Endpoint im Prometheus-Textformat (http://METRICS_HOST:METRICS_PORT/metrics); ohne Port aus
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+
+EXTENSIONS = (
+    "cogs.basic",
+    "cogs.embed_creator",
+    "cogs.self_roles",
+    "cogs.welcome",
+    "cogs.leveling",
+)
+COMMAND_TREE_HASH_FILE = pathlib.Path("data") / "command_tree.hash"
+
+# Startzeiten (Sekunden) pro Phase, werden beim ersten on_ready ausgegeben
+startup_timings = {}
+_startup_t0 = time.perf_counter()
+_connect_t0 = None
 
 # Bot
 intents = discord.Intents.default()
@@ -21,42 +80,201 @@ intents.message_content = True
 intents.members = True
 intents.reactions = True
 intents.voice_states = True
-bot = commands.Bot(command_prefix="/", intents=intents)
+member_cache_options = {}
+if LEAN_MEMBER_CACHE:
+    member_cache_flags = discord.MemberCacheFlags.none()
+    member_cache_flags.voice = True
+    member_cache_options = {"member_cache_flags": member_cache_flags, "chunk_guilds_at_startup": False}
+# Der messende CommandTree wird nur bei aktivierten Metriken installiert
+bot_options = dict(member_cache_options, tree_cls=MetricsCommandTree) if METRICS_PORT else member_cache_options
+if SHARDING:
+    bot = commands.AutoShardedBot(
+        command_prefix="/", intents=intents, shard_count=SHARD_COUNT, shard_ids=SHARD_IDS, **bot_options
+    )
+else:
+    bot = commands.Bot(command_prefix="/", intents=intents, **bot_options)
+# Singleton-Jobs (Command-Sync, globale Wartung) laufen nur auf Cluster 0
+bot.cluster_id = CLUSTER_ID
+bot.is_primary_cluster = CLUSTER_ID == 0
 
-# Events
-@bot.event
-async def on_ready():
-    print(f"✅ Logged in as {bot.user} (ID: {bot.user.id})")
+# Startup-Helfer
+def _timed(phase: str, started: float) -> None:
+    startup_timings[phase] = time.perf_counter() - started
+    print(f"⏱️  {phase}: {startup_timings[phase] * 1000:.0f} ms")
+
+def rss_mb() -> float:
+    """Aktueller Resident Set Size des Prozesses in MB (Linux: /proc, sonst Spitzenwert via resource)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+def command_tree_hash(guild: discord.abc.Snowflake) -> str:
+    """Stabiler Hash über alle Command-Definitionen der Guild (Reihenfolge-unabhängig)."""
+    payload = [
+        cmd.to_dict(bot.tree)
+        for cmd_type in (discord.AppCommandType.chat_input, discord.AppCommandType.user, discord.AppCommandType.message)
+        for cmd in bot.tree.get_commands(guild=guild, type=cmd_type)
+    ]
+    payload.sort(key=lambda c: (c.get("type", 1), c["name"]))
+    raw = json.dumps({"guild_id": guild.id, "commands": payload}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _read_tree_hash() -> str:
+    try:
+        return COMMAND_TREE_HASH_FILE.read_text(encoding="utf-8").strip()
+    except OSError:
+        return ""
+
+def _write_tree_hash(digest: str) -> None:
+    COMMAND_TREE_HASH_FILE.parent.mkdir(exist_ok=True)
+    COMMAND_TREE_HASH_FILE.write_text(digest, encoding="utf-8")
+
+async def sync_command_tree():
+    """Synchronisiert den Command Tree der Guild nur, wenn sich der Hash der Definitionen geändert hat."""
     try:
+        started = time.perf_counter()
         guild = discord.Object(id=TEST_GUILD_ID)
         bot.tree.copy_global_to(guild=guild)
-        synced = await bot.tree.sync(guild=guild)
-        print(f"🔁 Synced {len(synced)} command(s) to guild {TEST_GUILD_ID}")
+        digest = command_tree_hash(guild)
+        if not FORCE_COMMAND_SYNC and digest == await asyncio.to_thread(_read_tree_hash):
+            print(f"🔁 Command tree unchanged, sync skipped (guild {TEST_GUILD_ID})")
+        else:
+            synced = await bot.tree.sync(guild=guild)
+            await asyncio.to_thread(_write_tree_hash, digest)
+            print(f"🔁 Synced {len(synced)} command(s) to guild {TEST_GUILD_ID}")
+        if "command sync" not in startup_timings:
+            _timed("command sync", started)
     except Exception as e:
         print(f"Slash command sync failed: {e}")
 
+# Events
+@bot.event
+async def on_ready():
+    shards = f", shards {sorted(bot.shards)} von {bot.shard_count}" if SHARDING else ""
+    print(f"✅ Logged in as {bot.user} (ID: {bot.user.id}), cluster {CLUSTER_ID}{shards}")
+    if "gateway connect" not in startup_timings and _connect_t0 is not None:
+        _timed("gateway connect", _connect_t0)
+
+    # on_ready kommt auch nach Reconnects: nur synchronisieren, wenn sich die Commands geändert haben
+    if bot.is_primary_cluster:
+        await sync_command_tree()
+
+    if "total" not in startup_timings:
+        _timed("total", _startup_t0)
+        cached_members = sum(len(g.members) for g in bot.guilds)
+        mode = "lean" if LEAN_MEMBER_CACHE else "full"
+        print(f"📊 Member cache {mode}: {cached_members} member(s) cached, RSS {rss_mb():.1f} MB at ready")
+
 # DB
-async def setup_db_pool():
-    bot.db_pool = await aiomysql.create_pool(
-        host=DB_HOST,
-        port=DB_PORT,
-        user=DB_USER,
-        password=DB_PASS,
-        db=DB_NAME,
+async def create_instrumented_pool(host, port, user, password, db, name: str, minsize: int = DB_POOL_MIN) -> InstrumentedPool:
+    pool = await aiomysql.create_pool(
+        host=host,
+        port=port,
+        user=user,
+        password=password,
+        db=db,
         autocommit=True,
-        charset="utf8mb4"
+        charset="utf8mb4",
+        minsize=minsize,
+        maxsize=DB_POOL_MAX,
+        connect_timeout=DB_CONNECT_TIMEOUT,
+        pool_recycle=DB_POOL_RECYCLE,
     )
-    print("🗄️  MySQL pool ready")
+    return InstrumentedPool(pool, query_timeout=DB_QUERY_TIMEOUT, slow_query_seconds=DB_SLOW_QUERY_MS / 1000, name=name)
+
+async def setup_db_pool():
+    started = time.perf_counter()
+    # Alle Cogs gehen über bot.db_pool -> Wartezeit, Latenzen und langsame Abfragen werden zentral erfasst
+    bot.db_pool = await create_instrumented_pool(DB_HOST, DB_PORT, DB_USER, DB_PASS, DB_NAME, "db")
+    print(f"🗄️  MySQL pool ready ({DB_POOL_MIN}–{DB_POOL_MAX} connections)")
+    bot.db_read_pool = bot.db_pool
+    if DB_READ_HOST:
+        # minsize=0: der Pool öffnet beim Anlegen keine Verbindung. Ist die Replica beim Start nicht
+        # erreichbar, lesen alle vom Primary, bis der Health-Check sie wieder aktiviert.
+        replica = await create_instrumented_pool(
+            DB_READ_HOST, DB_READ_PORT, DB_READ_USER, DB_READ_PASS, DB_READ_NAME, "db-read", minsize=0
+        )
+        bot.db_read_pool = ReplicaPool(
+            bot.db_pool, replica, max_lag=DB_READ_MAX_LAG_SECONDS, check_interval=DB_READ_CHECK_SECONDS
+        )
+        if await bot.db_read_pool.check():
+            print(f"🗄️  MySQL read replica {DB_READ_HOST}:{DB_READ_PORT} ready (max lag {DB_READ_MAX_LAG_SECONDS:.0f} s)")
+        else:
+            print(f"⚠️  Read replica {DB_READ_HOST}:{DB_READ_PORT} not usable yet, reads use the primary until it recovers")
+        bot.db_read_pool.start()
+    _timed("db pool", started)
+
+async def log_db_stats():
+    while True:
+        await asyncio.sleep(DB_STATS_LOG_SECONDS)
+        print(bot.db_pool.format_stats())
+        if bot.db_read_pool is not bot.db_pool:
+            print(bot.db_read_pool.format_stats())
+
+# Metriken
+def gateway_latency_gauges():
+    latencies = bot.latencies if SHARDING else [(None, bot.latency)]
+    for shard_id, latency in latencies:
+        if not math.isfinite(latency):
+            continue  # noch kein Heartbeat
+        labels = (("shard", str(shard_id)),) if shard_id is not None else ()
+        yield "discord_gateway_latency_seconds", labels, latency
+
+def db_pool_histograms():
+    yield from bot.db_pool.metric_histograms()
+    if bot.db_read_pool is not bot.db_pool:
+        yield from bot.db_read_pool.replica.metric_histograms()
+
+def db_pool_gauges():
+    yield from bot.db_pool.metric_gauges()
+    if bot.db_read_pool is not bot.db_pool:
+        yield from bot.db_read_pool.replica.metric_gauges()
+
+async def on_app_command_completion(interaction: discord.Interaction, _command):
+    MetricsCommandTree.observe(interaction, "ok")
+
+async def setup_metrics():
+    metrics.enabled = True
+    metrics.gauge_collectors += [gateway_latency_gauges, db_pool_gauges, member_cache.metric_gauges]
+    metrics.histogram_collectors.append(db_pool_histograms)
+    bot.add_listener(on_app_command_completion)
+    bot.loop.create_task(probe_loop_lag())
+    await start_metrics_server(METRICS_HOST, METRICS_PORT)
+    print(f"📈 Metrics on http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def load_extension_timed(name: str):
+    started = time.perf_counter()
+    await bot.load_extension(name)
+    _timed(name, started)
 
 # Main
+def _close_on_sigterm():
+    # docker stop / systemctl stop schicken SIGTERM: wie bei Strg+C über bot.close() beenden,
+    # damit cog_unload die Puffer (XP, Voice, Level-Ups) noch in die DB schreibt
+    print("🛑 SIGTERM erhalten, fahre herunter …")
+    asyncio.get_running_loop().create_task(bot.close())
+
 async def main():
+    global _connect_t0
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, _close_on_sigterm)
+    except NotImplementedError:
+        pass  # Windows: keine Signal-Handler im Event-Loop
     async with bot:
         await setup_db_pool()
-        await bot.load_extension("cogs.basic")
-        await bot.load_extension("cogs.embed_creator")
-        await bot.load_extension("cogs.self_roles")
-        await bot.load_extension("cogs.welcome")
-        await bot.load_extension("cogs.leveling")
+        # Die Cogs hängen nicht voneinander ab -> setup/cog_load (z.B. DB-Laden der Self-Roles) parallel
+        started = time.perf_counter()
+        await asyncio.gather(*(load_extension_timed(name) for name in EXTENSIONS))
+        _timed("extensions", started)
+        if DB_STATS_LOG_SECONDS > 0:
+            bot.loop.create_task(log_db_stats())
+        if METRICS_PORT:
+            await setup_metrics()
+        _connect_t0 = time.perf_counter()
         await bot.start(TOKEN)
 
 if __name__ == "__main__":
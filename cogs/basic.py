@@ -29,6 +29,7 @@ class Basic(commands.Cog):
             "• `/selfroles_list` – zeigt aktuelle Bindungen.\n"
             "• `/selfroles_refresh` – aktualisiert Panel-Embed(s).\n"
             "• `/selfroles_delete` – löscht einen Selector (Panel bleibt bestehen).\n"
+            "• `/selfroles_reconcile` – gleicht Rollen mit den Reactions der Panels ab.\n"
             "\n"
             "👋 **Welcome System:**\n"
             "Neue Mitglieder werden automatisch im Willkommens-Channel begrüßt.\n"
@@ -1,18 +1,23 @@
 from __future__ import annotations
 import asyncio
+import heapq
 import random
 import time
-from dataclasses import dataclass
-from typing import Optional, List, Tuple
-from datetime import datetime, timedelta
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from dataclasses import dataclass, replace
+from typing import Optional, List, Tuple, Dict, Union
+from datetime import date, datetime, timedelta
 from zoneinfo import ZoneInfo
 
 import os
-import aiomysql
 import discord
 from discord import app_commands
 from discord.ext import commands, tasks
 
+from utils.db import InstrumentedCursor, InstrumentedPool, ReplicaPool
+from utils.metrics import TASK_BUCKETS, metrics
+
 # ========================= KONFIGURATION =========================
 # Kanal, in dem Nutzer ihren Level anfragen dürfen und wo wir auch Level-Ups & die Rangliste posten
 LEVEL_QUERY_CHANNEL_ID = 1410717838855114793
@@ -27,21 +32,156 @@ MESSAGE_XP_MAX = 25
 MESSAGE_COOLDOWN_SECONDS = 60  # Anti-Spam
 
 VOICE_XP_PER_MINUTE = 5        # XP pro Minute in einem nicht ausgeschlossenen Voice-Channel
-VOICE_XP_TICK_SECONDS = 60     # Intervall der Hintergrundaufgabe
+VOICE_XP_TICK_SECONDS = 60     # Intervall des Checkpoints (Gutschrift + Sicherung offener Sessions)
+VOICE_XP_IGNORE_DEAFENED = False  # True: Zeit mit (Self-)Deafen zählt nicht
+VOICE_SESSION_RESUME_MAX_GAP_SECONDS = 600  # max. angerechnete Offline-Zeit beim Fortsetzen nach Neustart
+
+# Write-Behind: Nachrichten-XP & Cooldowns werden im Speicher gesammelt und gebündelt geschrieben
+XP_WRITE_BEHIND = True
+XP_FLUSH_INTERVAL_SECONDS = 10  # spätestens nach dieser Zeit landet gepufferte XP in der DB
+XP_FLUSH_BATCH_SIZE = 200       # max. Nutzer pro Sammel-Upsert (volle Batches werden sofort geschrieben)
+
+# Nachrichten-Ingestion: begrenzte Queue + feste Anzahl Worker statt unbegrenzt vieler DB-Tasks
+INGEST_QUEUE_SIZE = 1000
+INGEST_WORKERS = 4
+INGEST_DROP_LOG_INTERVAL_SECONDS = 60  # höchstens so oft wird Lastabwurf geloggt
+INGEST_DRAIN_TIMEOUT_SECONDS = 10      # beim Entladen so lange auf die Abarbeitung der Queue warten
+
+# Level-Up-Meldungen: begrenzte Queue + eigener Sender, Level-Ups pro Kanal werden zusammengefasst
+LEVEL_UP_QUEUE_SIZE = 500         # volle Queue -> Meldung wird verworfen (XP-Gutschrift wartet nie)
+LEVEL_UP_COALESCE_SECONDS = 2.0   # Sammelfenster pro Nachricht
+LEVEL_UP_MAX_MENTIONS = 25        # max. Mitglieder pro Sammelnachricht (2000-Zeichen-Limit)
+LEVEL_UP_DRAIN_TIMEOUT_SECONDS = 15  # beim Entladen so lange auf das Absenden offener Meldungen warten
+
+# Profil-Cache (LRU + TTL): Cooldown-Prüfungen & /level ohne DB-Zugriff
+PROFILE_CACHE_SIZE = 5000
+PROFILE_CACHE_TTL_SECONDS = 300
 
 # Rangliste täglich um 08:00 Uhr (Europe/Zurich)
 LEADERBOARD_POST_HOUR = 8
 LEADERBOARD_POST_MINUTE = 0
 LEADERBOARD_TIMEZONE = ZoneInfo("Europe/Zurich")
 LEADERBOARD_SIZE = 10
+LEADERBOARD_RENDER_CACHE_SECONDS = 60   # gleiche Top-N innerhalb dieser Zeit -> gecachtes Embed
+LEADERBOARD_TOP_K = 50                  # Größe des In-Memory-Top-K (Puffer über LEADERBOARD_SIZE)
+LEADERBOARD_CHECKPOINT_SECONDS = 300    # Intervall, in dem der Top-K-Snapshot des Tages gesichert wird
+LEADERBOARD_SNAPSHOT_RETENTION_DAYS = 30
+
+# Speicherung pro Guild in member_xp (guild_id, user_id). XP aus der alten globalen users-Tabelle
+# werden bei der Migration dieser Guild zugeordnet.
+LEGACY_GUILD_ID = int(os.getenv("GUILD_ID", "0"))
+MEMBER_XP_PARTITIONS = 0  # >0: member_xp beim Anlegen per KEY(guild_id) in so viele Partitionen aufteilen
+
+# Online-Migration users -> member_xp (inkl. Alt-Schema xp/level) in kleinen Häppchen
+MIGRATION_CHUNK_SIZE = 1000
+MIGRATION_CHUNK_PAUSE_SECONDS = 0.05
 
 # ========================= HILFSKLASSEN =========================
+MemberKey = Tuple[int, int]  # (guild_id, user_id)
+
+
 @dataclass
 class Profile:
     user_id: int
     xp: int
     level: int
     last_msg_ts: float
+    total_xp: int = 0
+    guild_id: int = 0
+
+    @classmethod
+    def from_total(cls, guild_id: int, user_id: int, total_xp: int, last_msg_ts: float = 0.0) -> "Profile":
+        level, xp = split_total_xp(total_xp)
+        return cls(user_id=user_id, xp=xp, level=level, last_msg_ts=last_msg_ts, total_xp=total_xp, guild_id=guild_id)
+
+
+@dataclass
+class PendingXP:
+    """Noch nicht geschriebene XP-Gutschrift eines Nutzers (Write-Behind-Puffer)."""
+    xp: int = 0
+    last_msg_ts: float = 0.0
+    guild: Optional[discord.Guild] = None
+    member: Optional[discord.Member] = None
+
+    def merge(self, other: "PendingXP") -> None:
+        self.xp += other.xp
+        self.last_msg_ts = max(self.last_msg_ts, other.last_msg_ts)
+        self.guild = other.guild or self.guild
+        self.member = other.member or self.member
+
+
+@dataclass
+class VoiceSession:
+    """Offene Voice-Session eines Mitglieds; gezählt wird nur Zeit im XP-berechtigten Zustand."""
+    guild_id: int
+    user_id: int
+    channel_id: int = 0
+    since: float = 0.0           # Beginn des noch nicht angerechneten Abschnitts
+    carry_seconds: float = 0.0   # angerechnete Sekunden, die noch nicht in XP umgewandelt wurden
+    eligible: bool = True
+    member: Optional[discord.Member] = None
+
+    def accrue(self, now: float) -> None:
+        if self.eligible:
+            self.carry_seconds += max(0.0, now - self.since)
+        self.since = now
+
+    def take_xp(self, final: bool = False) -> int:
+        """Wandelt angesparte Zeit in XP um; bei `final` wird auch die angefangene Minute anteilig gerundet."""
+        if VOICE_XP_PER_MINUTE <= 0:
+            return 0
+        exact = self.carry_seconds * VOICE_XP_PER_MINUTE / 60
+        xp = round(exact) if final else int(exact)
+        self.carry_seconds = max(0.0, self.carry_seconds - xp * 60 / VOICE_XP_PER_MINUTE)
+        return xp
+
+
+class ProfileCache:
+    """Begrenzter LRU-Cache für Profile ((guild_id, user_id) -> Profile) mit TTL und Hit/Miss-Zählern."""
+
+    def __init__(self, max_size: int = PROFILE_CACHE_SIZE, ttl: float = PROFILE_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[MemberKey, Tuple[float, Profile]]" = OrderedDict()
+
+    def get(self, key: MemberKey) -> Optional[Profile]:
+        entry = self._data.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._data[key]
+            self.misses += 1
+            return None
+        self._data.move_to_end(key)
+        self.hits += 1
+        return replace(entry[1])
+
+    def put(self, profile: Profile) -> None:
+        key = (profile.guild_id, profile.user_id)
+        self._data[key] = (time.monotonic(), replace(profile))
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def peek(self, key: MemberKey) -> Optional[Profile]:
+        """Lesen ohne LRU-Update und ohne Hit/Miss-Zählung (für Vorfilter)."""
+        entry = self._data.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            return None
+        return entry[1]
+
+    def update(self, key: MemberKey, **fields) -> None:
+        """Write-Through: aktualisiert einen vorhandenen Eintrag (fehlende werden lazy geladen)."""
+        entry = self._data.get(key)
+        if entry is not None:
+            self._data[key] = (entry[0], replace(entry[1], **fields))
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, int]:
+        return {"size": len(self._data), "hits": self.hits, "misses": self.misses}
 
 
 def xp_for_next_level(level: int) -> int:
@@ -50,14 +190,106 @@ def xp_for_next_level(level: int) -> int:
 
 
 def total_xp_at_level(level: int) -> int:
-    total = 0
-    for l in range(level):
-        total += xp_for_next_level(l)
-    return total
+    """Gesamt-XP, ab der Level `level` erreicht ist (geschlossene Form der Summe über xp_for_next_level)."""
+    if level <= 0:
+        return 0
+    return (5 * (level - 1) * level * (2 * level - 1)) // 6 + 25 * level * (level - 1) + 100 * level
+
+
+# Präfixsummen-Tabelle: _CUMULATIVE_XP[L] == total_xp_at_level(L), für bisect in level_from_total_xp
+MAX_PRECOMPUTED_LEVEL = 1000
+_CUMULATIVE_XP: List[int] = [total_xp_at_level(l) for l in range(MAX_PRECOMPUTED_LEVEL + 1)]
+
+
+def level_from_total_xp(total_xp: int) -> int:
+    """Level zu Gesamt-XP in O(log n) per bisect, unabhängig von der Größe der Gutschrift."""
+    if total_xp < _CUMULATIVE_XP[-1]:
+        return max(bisect_right(_CUMULATIVE_XP, total_xp) - 1, 0)
+    # Jenseits der Tabelle: exponentielle + binäre Suche über die geschlossene Form
+    lo, hi = MAX_PRECOMPUTED_LEVEL, MAX_PRECOMPUTED_LEVEL * 2
+    while total_xp_at_level(hi) <= total_xp:
+        lo, hi = hi, hi * 2
+    while hi - lo > 1:
+        mid = (lo + hi) // 2
+        if total_xp_at_level(mid) <= total_xp:
+            lo = mid
+        else:
+            hi = mid
+    return lo
+
+
+def split_total_xp(total_xp: int) -> Tuple[int, int]:
+    """Zerlegt Gesamt-XP in (Level, XP innerhalb des Levels)."""
+    level = level_from_total_xp(total_xp)
+    return level, total_xp - total_xp_at_level(level)
+
+
+# total_xp_at_level(level) als SQL-Ausdruck, für die Migration der Alt-Spalten
+TOTAL_XP_AT_LEVEL_SQL = "((5 * (level - 1) * level * (2 * level - 1)) DIV 6 + 25 * level * (level - 1) + 100 * level)"
+
+
+class RankIndex:
+    """
+    Sortierte Liste von (total_xp, user_id) als Order-Statistic-Struktur für die Rangabfrage.
+    Rang = Anzahl Einträge mit mehr XP + 1, per bisect in O(log n); Updates verschieben einen Eintrag.
+    """
 
+    def __init__(self, entries: List[Tuple[int, int]]):
+        self._entries = sorted(entries)
+        # Tatsächlich eingetragener Stand pro Nutzer: der Index kann (von einer Replica) leicht veraltet geladen sein
+        self._totals: Dict[int, int] = {user_id: total for total, user_id in self._entries}
 
-def combined_score(level: int, xp_in_level: int) -> int:
-    return total_xp_at_level(level) + xp_in_level
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def move(self, user_id: int, old_total: int, new_total: int) -> None:
+        old_total = self._totals.get(user_id, old_total)
+        i = bisect_left(self._entries, (old_total, user_id))
+        if i < len(self._entries) and self._entries[i] == (old_total, user_id):
+            del self._entries[i]
+        insort(self._entries, (new_total, user_id))
+        self._totals[user_id] = new_total
+
+    def rank(self, total_xp: int) -> int:
+        # (total_xp + 1, -1) liegt vor allen Einträgen mit total_xp + 1, da user_ids positiv sind
+        return len(self._entries) - bisect_left(self._entries, (total_xp + 1, -1)) + 1
+
+
+class TopK:
+    """
+    In-Memory-Top-K nach total_xp: Min-Heap (mit verzögertem Löschen veralteter Einträge) + dict user_id -> total_xp.
+    Da XP nur wachsen, genügt pro Gutschrift ein Vergleich mit dem aktuellen Minimum.
+    """
+
+    def __init__(self, k: int, entries: List[Tuple[int, int]]):
+        self.k = k
+        self._totals: Dict[int, int] = {}
+        self._heap: List[Tuple[int, int]] = []
+        for user_id, total_xp in entries:
+            self.update(user_id, total_xp)
+
+    def _min(self) -> Tuple[int, int]:
+        while self._heap and self._totals.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+        return self._heap[0]
+
+    def update(self, user_id: int, total_xp: int) -> None:
+        if user_id not in self._totals:
+            if len(self._totals) >= self.k:
+                min_total, min_user = self._min()
+                if total_xp <= min_total:
+                    return
+                heapq.heappop(self._heap)
+                del self._totals[min_user]
+        self._totals[user_id] = total_xp
+        heapq.heappush(self._heap, (total_xp, user_id))
+        if len(self._heap) > 4 * self.k:
+            self._heap = [(t, u) for u, t in self._totals.items()]
+            heapq.heapify(self._heap)
+
+    def top(self, n: int) -> List[Tuple[int, int]]:
+        """Die besten `n` als (user_id, total_xp), absteigend."""
+        return sorted(self._totals.items(), key=lambda e: e[1], reverse=True)[:n]
 
 
 class Leveling(commands.Cog):
@@ -65,125 +297,706 @@ class Leveling(commands.Cog):
 
     def __init__(self, bot: commands.Bot):
         self.bot = bot
+        # Write-Behind-Puffer: (guild_id, user_id) -> PendingXP (+ der gerade geschriebene Batch)
+        self._pending_xp: Dict[MemberKey, PendingXP] = {}
+        self._flushing_xp: Dict[MemberKey, PendingXP] = {}
+        self._flush_lock = asyncio.Lock()
+        self.profile_cache = ProfileCache()
+        # Rang-Indizes pro Guild, lazy beim ersten /level der Guild geladen
+        self.rank_indexes: Dict[int, RankIndex] = {}
+        # Laufende Index-Ladevorgänge (einer pro Guild) und währenddessen gemeldete neue Stände
+        self._rank_index_loads: Dict[int, asyncio.Task] = {}
+        self._rank_index_moves: Dict[int, Dict[int, int]] = {}
+        # Voice-Ledger: (guild_id, user_id) -> offene Session, plus noch nicht geschriebene Gutschriften
+        self._voice_sessions: Dict[MemberKey, VoiceSession] = {}
+        self._closed_voice_sessions: set = set()
+        self._voice_awards: Dict[MemberKey, PendingXP] = {}
+        self._voice_checkpoint_lock = asyncio.Lock()
+        # Rangliste: guild_id -> (Top-N, Zeitpunkt, Embed)
+        self._leaderboard_embeds: Dict[int, Tuple[tuple, float, discord.Embed]] = {}
+        # Materialisierte Rangliste pro Guild: Top-K im Speicher, Tages-Snapshots in leaderboard_snapshots
+        self.top_ks: Dict[int, TopK] = {}
+        self._previous_positions: Dict[int, Tuple[date, Dict[int, int]]] = {}
+        self._voice_ledger_restored = False  # vorher keine Checkpoints, sonst würden gesicherte Sessions überschrieben
         self.voice_xp_task.start()
         self.daily_leaderboard_task.start()
+        self.leaderboard_checkpoint_task.start()
+        if XP_WRITE_BEHIND:
+            self.xp_flush_task.start()
         # DB-Struktur sicherstellen
         self.bot.loop.create_task(self._ensure_schema())
+        # Level-Up-Meldungen: (Kanal, Mitglied, Level)
+        # None in der Queue beendet den Sender (nach dem Absenden seines aktuellen Batches)
+        self._level_up_queue: "asyncio.Queue[Optional[Tuple[discord.abc.Messageable, discord.Member, int]]]" = asyncio.Queue(
+            maxsize=LEVEL_UP_QUEUE_SIZE
+        )
+        self.level_ups_dropped = 0
+        self._level_up_sender_task = self.bot.loop.create_task(self._level_up_sender())
+        # Nachrichten-Ingestion: Queue + Worker, Schlüssel bereits eingereihter Mitglieder, Zähler
+        self._ingest_queue: "asyncio.Queue[discord.Message]" = asyncio.Queue(maxsize=INGEST_QUEUE_SIZE)
+        self._ingest_queued: set = set()
+        self.ingest_counters: Dict[str, int] = {
+            "enqueued": 0, "processed": 0, "shed_cooldown": 0, "coalesced": 0, "dropped_full": 0,
+            "dropped_shutdown": 0, "errors": 0,
+        }
+        self._ingest_last_drop_log = 0.0
+        self._ingest_workers = [self.bot.loop.create_task(self._ingest_worker()) for _ in range(INGEST_WORKERS)]
+        # Queue-Tiefe + Zähler auf /metrics (nur abgefragt, wenn der Endpoint aktiv ist)
+        metrics.gauge_collectors.append(self.metric_gauges)
 
     # -------------------- DB Utilities --------------------
     @property
-    def pool(self) -> aiomysql.Pool:
+    def pool(self) -> InstrumentedPool:
         return getattr(self.bot, "db_pool")
 
+    @property
+    def read_pool(self) -> Union[InstrumentedPool, ReplicaPool]:
+        """Lesepool für reine Anzeige-/Ranglisten-Abfragen (Replica mit Fallback, sonst der Primary)."""
+        return getattr(self.bot, "db_read_pool", None) or self.pool
+
+    @property
+    def is_primary_cluster(self) -> bool:
+        """Im Cluster-Betrieb laufen globale Wartungsjobs nur auf Cluster 0 (ohne Cluster: immer)."""
+        return getattr(self.bot, "is_primary_cluster", True)
+
     async def _ensure_schema(self):
         await self.bot.wait_until_ready()
+        partitioning = f" PARTITION BY KEY(guild_id) PARTITIONS {MEMBER_XP_PARTITIONS}" if MEMBER_XP_PARTITIONS > 0 else ""
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
+                    f"""
+                    CREATE TABLE IF NOT EXISTS member_xp (
+                        guild_id BIGINT NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        total_xp BIGINT NOT NULL DEFAULT 0,
+                        last_msg_ts DOUBLE DEFAULT 0,
+                        PRIMARY KEY (guild_id, user_id),
+                        KEY idx_member_xp_guild_total (guild_id, total_xp)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4{partitioning};
                     """
-                    CREATE TABLE IF NOT EXISTS users (
-                        user_id BIGINT PRIMARY KEY,
-                        xp INT NOT NULL DEFAULT 0,
-                        level INT NOT NULL DEFAULT 0,
-                        last_msg_ts DOUBLE DEFAULT 0
+                )
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS voice_sessions (
+                        guild_id BIGINT NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        checkpoint_ts DOUBLE NOT NULL,
+                        carry_seconds DOUBLE NOT NULL DEFAULT 0,
+                        PRIMARY KEY (guild_id, user_id)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                    """
+                )
+                # Snapshots sind abgeleitete Daten: die Variante ohne guild_id wird einfach neu angelegt
+                snapshot_columns = await self._table_columns(cur, "leaderboard_snapshots")
+                if snapshot_columns and "guild_id" not in snapshot_columns and self.is_primary_cluster:
+                    await cur.execute("DROP TABLE leaderboard_snapshots")
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS leaderboard_snapshots (
+                        guild_id BIGINT NOT NULL,
+                        snapshot_date DATE NOT NULL,
+                        position INT NOT NULL,
+                        user_id BIGINT NOT NULL,
+                        total_xp BIGINT NOT NULL,
+                        PRIMARY KEY (guild_id, snapshot_date, position)
                     ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
                     """
                 )
+                # Tägliche Posts pro Guild+Tag beanspruchen, damit mehrere Prozesse nie doppelt posten
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS leaderboard_posts (
+                        guild_id BIGINT NOT NULL,
+                        post_date DATE NOT NULL,
+                        PRIMARY KEY (guild_id, post_date)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                    """
+                )
+                # Die Migration ist ein globaler Einmal-Job -> nur auf dem primären Cluster
+                legacy_columns = await self._table_columns(cur, "users") if self.is_primary_cluster else set()
+        await self._restore_voice_sessions()
+        if legacy_columns and not LEGACY_GUILD_ID:
+            print("[leveling] Tabelle users gefunden, aber GUILD_ID ist nicht gesetzt – Migration übersprungen")
+        elif legacy_columns:
+            await self._migrate_global_users(legacy_columns)
+            # Vor/während der Migration geladene Ranglisten-Strukturen verwerfen und neu aufbauen lassen
+            for task in list(self._rank_index_loads.values()):
+                task.cancel()
+            self._rank_index_loads.clear()
+            self._rank_index_moves.clear()
+            self.rank_indexes.clear()
+            self.top_ks.clear()
+            # Während der Migration gecachte Profile tragen noch die alten Stände
+            self.profile_cache.clear()
+
+    @staticmethod
+    async def _table_columns(cur: InstrumentedCursor, table: str) -> set:
+        await cur.execute(
+            "SELECT column_name FROM information_schema.columns WHERE table_schema = DATABASE() AND table_name = %s",
+            (table,),
+        )
+        return {str(r[0]).lower() for r in await cur.fetchall()}
+
+    async def _migrate_global_users(self, columns: set):
+        """
+        Verschiebt die alte globale users-Tabelle in Häppchen à MIGRATION_CHUNK_SIZE nach member_xp (Guild LEGACY_GUILD_ID).
+        Pro Häppchen in einer Transaktion: INSERT ... SELECT (addiert auf evtl. schon vorhandene Gutschriften) + DELETE.
+        Dadurch gehen parallele Gutschriften nicht verloren, ein erneuter Lauf zählt nichts doppelt und
+        Sperren halten nur für ein Häppchen. Das Alt-Schema (xp/level) wird dabei gleich nach total_xp umgerechnet.
+        """
+        parts = []
+        if "total_xp" in columns:
+            parts.append("total_xp")
+        if {"xp", "level"} <= columns:
+            parts.append(f"{TOTAL_XP_AT_LEVEL_SQL} + xp")
+        total_expr = " + ".join(parts) or "0"
+        ts_expr = "COALESCE(last_msg_ts, 0)" if "last_msg_ts" in columns else "0"
+        migrated = 0
+        while True:
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        await cur.execute(
+                            "SELECT user_id FROM users ORDER BY user_id LIMIT %s FOR UPDATE", (MIGRATION_CHUNK_SIZE,)
+                        )
+                        ids = [int(r[0]) for r in await cur.fetchall()]
+                        if ids:
+                            await cur.execute(
+                                f"INSERT INTO member_xp (guild_id, user_id, total_xp, last_msg_ts) "
+                                f"SELECT %s, user_id, {total_expr}, {ts_expr} FROM users WHERE user_id BETWEEN %s AND %s "
+                                "ON DUPLICATE KEY UPDATE total_xp = member_xp.total_xp + VALUES(total_xp), "
+                                "last_msg_ts = GREATEST(COALESCE(member_xp.last_msg_ts, 0), VALUES(last_msg_ts))",
+                                (LEGACY_GUILD_ID, ids[0], ids[-1]),
+                            )
+                            await cur.execute("DELETE FROM users WHERE user_id BETWEEN %s AND %s", (ids[0], ids[-1]))
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+            if not ids:
+                break
+            migrated += len(ids)
+            await asyncio.sleep(MIGRATION_CHUNK_PAUSE_SECONDS)
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("DROP TABLE IF EXISTS users")
+        if migrated:
+            print(f"[leveling] {migrated} Profil(e) aus users nach member_xp (Guild {LEGACY_GUILD_ID}) migriert")
+
+    def _schedule_rank_index(self, guild_id: int) -> None:
+        """Startet den Aufbau des RankIndex im Hintergrund (höchstens ein Ladevorgang pro Guild)."""
+        if guild_id not in self.rank_indexes and guild_id not in self._rank_index_loads:
+            self._rank_index_moves[guild_id] = {}
+            self._rank_index_loads[guild_id] = self.bot.loop.create_task(self._load_rank_index(guild_id))
+
+    async def _load_rank_index(self, guild_id: int) -> None:
+        try:
+            # Voller Guild-Scan -> Replica; später geschriebene Stände korrigiert move() pro Nutzer
+            async with self.read_pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    await cur.execute("SELECT total_xp, user_id FROM member_xp WHERE guild_id=%s", (guild_id,))
+                    rows = await cur.fetchall()
+            index = RankIndex([(int(r[0] or 0), int(r[1])) for r in rows])
+            # Während des Scans gutgeschriebene XP nachziehen
+            for user_id, total in self._rank_index_moves.get(guild_id, {}).items():
+                index.move(user_id, total, total)
+            self.rank_indexes[guild_id] = index
+        except Exception as e:
+            print(f"[leveling] RankIndex für Guild {guild_id} konnte nicht geladen werden: {e}")
+        finally:
+            # Nur die eigenen Einträge freigeben (nach einem Abbruch kann schon ein neuer Ladevorgang laufen)
+            if self._rank_index_loads.get(guild_id) is asyncio.current_task():
+                del self._rank_index_loads[guild_id]
+                self._rank_index_moves.pop(guild_id, None)
+
+    async def _get_top_k(self, guild_id: int) -> TopK:
+        top_k = self.top_ks.get(guild_id)
+        if top_k is None:
+            top = await self.top_users(guild_id, LEADERBOARD_TOP_K)
+            top_k = TopK(LEADERBOARD_TOP_K, [(p.user_id, p.total_xp) for p in top])
+            self.top_ks[guild_id] = top_k
+        return top_k
+
+    def _track_total(self, key: MemberKey, old_total: int, new_total: int):
+        guild_id, user_id = key
+        if guild_id in self.rank_indexes:
+            self.rank_indexes[guild_id].move(user_id, old_total, new_total)
+        elif guild_id in self._rank_index_moves:
+            self._rank_index_moves[guild_id][user_id] = new_total
+        if guild_id in self.top_ks:
+            self.top_ks[guild_id].update(user_id, new_total)
+
+    async def get_profile(self, guild_id: int, user_id: int, read_only: bool = False) -> Profile:
+        """
+        read_only=True (Anzeige, z.B. /level): bei Cache-Miss von der Read-Replica, ohne Zeile anzulegen
+        und ohne den Cache zu füllen – die Cooldown-Prüfung braucht immer den Stand des Primary.
+        """
+        cached = self.profile_cache.get((guild_id, user_id))
+        if cached is not None:
+            return cached
+        if read_only:
+            return await self._read_profile(guild_id, user_id)
+        profile = await self._load_profile(guild_id, user_id)
+        self.profile_cache.put(profile)
+        return profile
+
+    async def _read_profile(self, guild_id: int, user_id: int) -> Profile:
+        async with self.read_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT total_xp, COALESCE(last_msg_ts, 0) FROM member_xp WHERE guild_id=%s AND user_id=%s",
+                    (guild_id, user_id),
+                )
+                row = await cur.fetchone()
+        if row is None:
+            return Profile.from_total(guild_id, user_id, 0)
+        return Profile.from_total(guild_id, user_id, int(row[0] or 0), float(row[1] or 0))
 
-    async def get_profile(self, user_id: int) -> Profile:
+    async def _load_profile(self, guild_id: int, user_id: int) -> Profile:
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
-                    "SELECT user_id, xp, level, COALESCE(last_msg_ts, 0) FROM users WHERE user_id=%s",
-                    (user_id,),
+                    "SELECT total_xp, COALESCE(last_msg_ts, 0) FROM member_xp WHERE guild_id=%s AND user_id=%s",
+                    (guild_id, user_id),
                 )
                 row = await cur.fetchone()
                 if row is None:
                     await cur.execute(
-                        "INSERT INTO users (user_id, xp, level, last_msg_ts) VALUES (%s, 0, 0, 0)",
-                        (user_id,),
+                        "INSERT IGNORE INTO member_xp (guild_id, user_id, total_xp, last_msg_ts) VALUES (%s, %s, 0, 0)",
+                        (guild_id, user_id),
                     )
-                    return Profile(user_id=user_id, xp=0, level=0, last_msg_ts=0)
-                return Profile(user_id=int(row[0]), xp=int(row[1]), level=int(row[2]), last_msg_ts=float(row[3] or 0))
+                    self._track_total((guild_id, user_id), 0, 0)
+                    return Profile.from_total(guild_id, user_id, 0)
+                return Profile.from_total(guild_id, user_id, int(row[0] or 0), float(row[1] or 0))
 
-    async def add_xp(self, user_id: int, amount: int) -> Tuple[int, int, bool]:
+    async def add_xp(self, guild_id: int, user_id: int, amount: int) -> Tuple[int, int, bool]:
+        """
+        Schreibt XP atomar in einem Statement gut (kein Read-Modify-Write).
+        LAST_INSERT_ID(expr) legt den neuen Gesamtstand ins OK-Paket, `cur.lastrowid` liefert ihn ohne weiteren Roundtrip.
+        """
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("SELECT xp, level FROM users WHERE user_id=%s", (user_id,))
-                row = await cur.fetchone()
-                if row is None:
-                    xp = 0
-                    level = 0
-                    await cur.execute("INSERT INTO users (user_id, xp, level) VALUES (%s, %s, %s)", (user_id, 0, 0))
-                else:
-                    xp = int(row[0] or 0)
-                    level = int(row[1] or 0)
-
-                xp += amount
-                leveled_up = False
-                while xp >= xp_for_next_level(level):
-                    xp -= xp_for_next_level(level)
-                    level += 1
-                    leveled_up = True
-
-                await cur.execute("UPDATE users SET xp=%s, level=%s WHERE user_id=%s", (xp, level, user_id))
-                return xp, level, leveled_up
-
-    async def update_last_message_ts(self, user_id: int, ts: float):
+                await cur.execute(
+                    "INSERT INTO member_xp (guild_id, user_id, total_xp, last_msg_ts) VALUES (%s, %s, LAST_INSERT_ID(%s), 0) "
+                    "ON DUPLICATE KEY UPDATE total_xp = LAST_INSERT_ID(total_xp + %s)",
+                    (guild_id, user_id, amount, amount),
+                )
+                new_total = int(cur.lastrowid or 0)
+        old_level = level_from_total_xp(new_total - amount)
+        level, xp = split_total_xp(new_total)
+        self._track_total((guild_id, user_id), new_total - amount, new_total)
+        self.profile_cache.update((guild_id, user_id), xp=xp, level=level, total_xp=new_total)
+        return xp, level, level > old_level
+
+    async def update_last_message_ts(self, guild_id: int, user_id: int, ts: float):
         async with self.pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("UPDATE users SET last_msg_ts=%s WHERE user_id=%s", (ts, user_id))
+                await cur.execute(
+                    "UPDATE member_xp SET last_msg_ts=%s WHERE guild_id=%s AND user_id=%s", (ts, guild_id, user_id)
+                )
+        self.profile_cache.update((guild_id, user_id), last_msg_ts=ts)
 
-    async def top_users(self, limit: int = LEADERBOARD_SIZE) -> List[Profile]:
+    async def _write_xp_batch(self, batch: Dict[MemberKey, PendingXP]) -> List[Tuple[MemberKey, int]]:
+        """
+        Schreibt einen Batch in einer Transaktion: 1 Sammel-Upsert (Deltas) + 1 SELECT der neuen Stände.
+        Die Upsert-Zeilensperren halten bis zum Commit, dadurch ist "neu - Delta" der exakte Vorher-Stand.
+        Gibt ((guild_id, user_id), neues Level) aller Mitglieder mit Level-Up zurück.
+        """
+        keys = list(batch)
+        placeholders = ", ".join(["(%s, %s)"] * len(keys))
+        level_ups: List[Tuple[MemberKey, int]] = []
         async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    await cur.executemany(
+                        "INSERT INTO member_xp (guild_id, user_id, total_xp, last_msg_ts) VALUES (%s, %s, %s, %s) "
+                        "ON DUPLICATE KEY UPDATE total_xp = total_xp + VALUES(total_xp), "
+                        "last_msg_ts = GREATEST(COALESCE(last_msg_ts, 0), VALUES(last_msg_ts))",
+                        [(gid, uid, p.xp, p.last_msg_ts) for (gid, uid), p in batch.items()],
+                    )
+                    await cur.execute(
+                        "SELECT guild_id, user_id, total_xp, COALESCE(last_msg_ts, 0) FROM member_xp "
+                        f"WHERE (guild_id, user_id) IN ({placeholders})",
+                        [part for key in keys for part in key],
+                    )
+                    rows = await cur.fetchall()
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+        for row in rows:
+            key, new_total = (int(row[0]), int(row[1])), int(row[2] or 0)
+            profile = Profile.from_total(key[0], key[1], new_total, float(row[3] or 0))
+            old_total = new_total - batch[key].xp
+            self._track_total(key, old_total, new_total)
+            if profile.level > level_from_total_xp(old_total):
+                level_ups.append((key, profile.level))
+            self.profile_cache.update(
+                key, xp=profile.xp, level=profile.level, total_xp=new_total, last_msg_ts=profile.last_msg_ts
+            )
+        return level_ups
+
+    async def flush_pending_xp(self):
+        """Schreibt den kompletten Write-Behind-Puffer in Batches à XP_FLUSH_BATCH_SIZE."""
+        async with self._flush_lock:
+            while self._pending_xp:
+                batch_keys = list(self._pending_xp)[:XP_FLUSH_BATCH_SIZE]
+                batch = {key: self._pending_xp.pop(key) for key in batch_keys}
+                self._flushing_xp = batch
+                try:
+                    level_ups = await self._write_xp_batch(batch)
+                except Exception as e:
+                    # Nichts verlieren: zurück in den Puffer, nächster Flush versucht es erneut
+                    for key, pending in batch.items():
+                        newer = self._pending_xp.get(key)
+                        if newer is not None:
+                            pending.merge(newer)
+                        self._pending_xp[key] = pending
+                    print(f"[xp_flush] Fehler beim Schreiben von {len(batch)} Nutzer(n): {e}")
+                    return
+                finally:
+                    self._flushing_xp = {}
+                self._announce_batch_level_ups(batch, level_ups)
+
+    def _announce_batch_level_ups(self, batch: Dict[MemberKey, PendingXP], level_ups: List[Tuple[MemberKey, int]]):
+        for key, new_level in level_ups:
+            pending = batch[key]
+            if pending.guild is not None and pending.member is not None:
+                self._announce_level_up(pending.guild, pending.member, new_level)
+
+    def _buffer_xp(self, member: discord.Member, amount: int, ts: float):
+        pending = self._pending_xp.setdefault((member.guild.id, member.id), PendingXP())
+        pending.merge(PendingXP(xp=amount, last_msg_ts=ts, guild=member.guild, member=member))
+        if len(self._pending_xp) >= XP_FLUSH_BATCH_SIZE and not self._flush_lock.locked():
+            self.bot.loop.create_task(self.flush_pending_xp())
+
+    def _buffered_last_msg_ts(self, key: MemberKey) -> Optional[float]:
+        pending = self._pending_xp.get(key) or self._flushing_xp.get(key)
+        return pending.last_msg_ts if pending else None
+
+    async def get_rank(self, guild_id: int, total_xp: int) -> Tuple[int, int]:
+        """
+        (Rang, Anzahl Mitglieder) zu einem XP-Stand innerhalb der Guild: aus deren RankIndex, solange
+        dieser noch im Hintergrund lädt per COUNT über idx_member_xp_guild_total.
+        """
+        index = self.rank_indexes.get(guild_id)
+        if index is not None:
+            return index.rank(total_xp), len(index)
+        self._schedule_rank_index(guild_id)
+        async with self.read_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT (SELECT COUNT(*) FROM member_xp WHERE guild_id=%s AND total_xp > %s) + 1, "
+                    "(SELECT COUNT(*) FROM member_xp WHERE guild_id=%s)",
+                    (guild_id, total_xp, guild_id),
+                )
+                row = await cur.fetchone()
+        return int(row[0]), int(row[1])
+
+    async def top_users(self, guild_id: int, limit: int = LEADERBOARD_SIZE) -> List[Profile]:
+        """Top-N der Guild über idx_member_xp_guild_total (Index-Scan rückwärts, liest nur `limit` Zeilen)."""
+        async with self.read_pool.acquire() as conn:
             async with conn.cursor() as cur:
-                await cur.execute("SELECT user_id, xp, level, COALESCE(last_msg_ts, 0) FROM users")
+                await cur.execute(
+                    "SELECT user_id, total_xp, COALESCE(last_msg_ts, 0) FROM member_xp "
+                    "WHERE guild_id=%s ORDER BY total_xp DESC LIMIT %s",
+                    (guild_id, limit),
+                )
                 rows = await cur.fetchall()
-        profiles = [Profile(int(r[0]), int(r[1] or 0), int(r[2] or 0), float(r[3] or 0)) for r in rows]
-        profiles.sort(key=lambda p: combined_score(p.level, p.xp), reverse=True)
-        return profiles[:limit]
+        return [Profile.from_total(guild_id, int(r[0]), int(r[1] or 0), float(r[2] or 0)) for r in rows]
 
     # -------------------- Events --------------------
     @commands.Cog.listener()
+    @metrics.timed("discord_listener_seconds", listener="Leveling.on_message")
     async def on_message(self, message: discord.Message):
+        """Nur Vorfilter + Einreihen, ohne DB: die eigentliche Verarbeitung machen die Ingestion-Worker."""
         if message.author.bot or not message.guild:
             return
+        key = (message.guild.id, message.author.id)
+        if self._in_known_cooldown(key, time.time()):
+            self.ingest_counters["shed_cooldown"] += 1
+            return
+        if key in self._ingest_queued:
+            # Mitglied wartet schon in der Queue: nur die erste Nachricht kann XP bringen
+            self.ingest_counters["coalesced"] += 1
+            return
+        try:
+            self._ingest_queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self.ingest_counters["dropped_full"] += 1
+            self._log_ingest_pressure()
+            return
+        self._ingest_queued.add(key)
+        self.ingest_counters["enqueued"] += 1
+
+    def _in_known_cooldown(self, key: MemberKey, now: float) -> bool:
+        """Cooldown-Prüfung nur aus dem Speicher (Write-Behind-Puffer, Profil-Cache); unbekannt -> False."""
+        last_ts = self._buffered_last_msg_ts(key)
+        if last_ts is None:
+            cached = self.profile_cache.peek(key)
+            last_ts = cached.last_msg_ts if cached else None
+        return last_ts is not None and now - last_ts < MESSAGE_COOLDOWN_SECONDS
+
+    def _log_ingest_pressure(self):
+        now = time.monotonic()
+        if now - self._ingest_last_drop_log >= INGEST_DROP_LOG_INTERVAL_SECONDS:
+            self._ingest_last_drop_log = now
+            print(f"[leveling] Ingestion überlastet: {self.ingest_stats()}")
+
+    def ingest_stats(self) -> Dict[str, int]:
+        return {"queue_depth": self._ingest_queue.qsize(), **self.ingest_counters}
+
+    def metric_gauges(self):
+        """Für utils.metrics: Ingestion- und Level-Up-Queues samt Zählern."""
+        yield "leveling_ingest_queue_depth", (), self._ingest_queue.qsize()
+        for outcome, count in self.ingest_counters.items():
+            yield "leveling_ingest_messages", (("outcome", outcome),), count
+        yield "leveling_level_up_queue_depth", (), self._level_up_queue.qsize()
+        yield "leveling_level_ups_dropped", (), self.level_ups_dropped
+
+    async def _drain_ingest_queue(self):
+        """Eingereihte Nachrichten noch abarbeiten lassen; was nach dem Timeout übrig ist, zählt als verworfen."""
+        try:
+            await asyncio.wait_for(self._ingest_queue.join(), INGEST_DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        for worker in self._ingest_workers:
+            worker.cancel()
+        dropped = 0
+        while not self._ingest_queue.empty():
+            self._ingest_queue.get_nowait()
+            self._ingest_queue.task_done()
+            dropped += 1
+        self._ingest_queued.clear()
+        if dropped:
+            self.ingest_counters["dropped_shutdown"] += dropped
+            print(f"[leveling] {dropped} Nachricht(en) beim Entladen nicht mehr verarbeitet: {self.ingest_stats()}")
+
+    async def _ingest_worker(self):
+        while True:
+            message = await self._ingest_queue.get()
+            try:
+                await self._process_message(message)
+                self.ingest_counters["processed"] += 1
+            except Exception as e:
+                self.ingest_counters["errors"] += 1
+                print(f"[leveling] Fehler bei Nachricht {message.id}: {e}")
+            finally:
+                self._ingest_queued.discard((message.guild.id, message.author.id))
+                self._ingest_queue.task_done()
+
+    @metrics.timed("leveling_message_processing_seconds")
+    async def _process_message(self, message: discord.Message):
         now = time.time()
-        profile = await self.get_profile(message.author.id)
-        if now - (profile.last_msg_ts or 0) < MESSAGE_COOLDOWN_SECONDS:
+        key = (message.guild.id, message.author.id)
+        last_ts = self._buffered_last_msg_ts(key) if XP_WRITE_BEHIND else None
+        if last_ts is None:
+            profile = await self.get_profile(*key)
+            last_ts = profile.last_msg_ts or 0
+        if now - last_ts < MESSAGE_COOLDOWN_SECONDS:
             return
 
         amount = random.randint(MESSAGE_XP_MIN, MESSAGE_XP_MAX)
-        new_xp, new_level, leveled = await self.add_xp(message.author.id, amount)
-        await self.update_last_message_ts(message.author.id, now)
+        if XP_WRITE_BEHIND:
+            self._buffer_xp(message.author, amount, now)
+            return
+
+        new_xp, new_level, leveled = await self.add_xp(*key, amount)
+        await self.update_last_message_ts(*key, now)
 
         if leveled:
-            await self._announce_level_up(message.guild, message.author, new_level)
+            self._announce_level_up(message.guild, message.author, new_level)
 
-    # -------------------- Voice-XP-Task --------------------
-    @tasks.loop(seconds=VOICE_XP_TICK_SECONDS)
-    async def voice_xp_task(self):
-        await self.bot.wait_until_ready()
+    @commands.Cog.listener()
+    async def on_voice_state_update(self, member: discord.Member, before: discord.VoiceState, after: discord.VoiceState):
+        if member.bot:
+            return
+        self._update_voice_session(member, after, time.time())
+
+    @commands.Cog.listener()
+    async def on_ready(self):
+        # Nach Reconnects können Voice-Events gefehlt haben: Ledger mit dem Voice-Cache abgleichen
+        self._sync_voice_sessions()
+        # RankIndex der eigenen Guilds vorladen, damit schon das erste /level nur noch bisect braucht
+        for guild in self.bot.guilds:
+            self._schedule_rank_index(guild.id)
+
+    # -------------------- Voice-Ledger --------------------
+    @staticmethod
+    def _voice_eligible(state: discord.VoiceState) -> bool:
+        if not isinstance(state.channel, discord.VoiceChannel) or state.channel.id == EXCLUDED_VOICE_CHANNEL_ID:
+            return False
+        if VOICE_XP_IGNORE_DEAFENED and (state.self_deaf or state.deaf):
+            return False
+        return True
+
+    def _update_voice_session(self, member: discord.Member, state: Optional[discord.VoiceState], now: float):
+        """Join/Leave/Move/Mute: bisherigen Abschnitt anrechnen, dann neuen Zustand übernehmen."""
+        key = (member.guild.id, member.id)
+        if state is None or state.channel is None:
+            self._close_voice_session(key, now)
+            return
+        session = self._voice_sessions.get(key)
+        if session is None:
+            session = VoiceSession(guild_id=member.guild.id, user_id=member.id, since=now)
+            self._voice_sessions[key] = session
+        else:
+            session.accrue(now)
+        session.member = member
+        session.channel_id = state.channel.id
+        session.eligible = self._voice_eligible(state)
+
+    def _close_voice_session(self, key: MemberKey, now: float):
+        session = self._voice_sessions.pop(key, None)
+        if session is None:
+            return
+        session.accrue(now)
+        self._queue_voice_award(session, session.take_xp(final=True))
+        self._closed_voice_sessions.add(key)
+
+    def _queue_voice_award(self, session: VoiceSession, xp: int):
+        if xp <= 0:
+            return
+        guild = self.bot.get_guild(session.guild_id)
+        award = self._voice_awards.setdefault((session.guild_id, session.user_id), PendingXP())
+        award.merge(PendingXP(xp=xp, guild=guild, member=session.member))
+
+    def _sync_voice_sessions(self):
+        now = time.time()
+        present: Dict[MemberKey, discord.Member] = {}
         for guild in list(self.bot.guilds):
+            for vc in list(guild.voice_channels) + list(guild.stage_channels):
+                for member in vc.members:
+                    if not member.bot:
+                        present[(guild.id, member.id)] = member
+        for key in list(self._voice_sessions):
+            if key not in present:
+                self._close_voice_session(key, now)
+        for member in present.values():
+            self._update_voice_session(member, member.voice, now)
+
+    async def _restore_voice_sessions(self):
+        """
+        Setzt beim Start gesicherte Sessions fort und schließt verwaiste ab.
+        Die Offline-Lücke (gedeckelt) wird nur angerechnet, wenn das Mitglied noch im selben Channel
+        sitzt und dort XP-berechtigt ist; alle anderen enden am letzten Checkpoint.
+        """
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute("SELECT guild_id, user_id, channel_id, checkpoint_ts, carry_seconds FROM voice_sessions")
+                rows = await cur.fetchall()
+        now = time.time()
+        for r in rows:
+            key = (int(r[0]), int(r[1]))
+            # Im Cluster-Betrieb gehören Sessions fremder Guilds dem jeweils anderen Prozess
+            guild = self.bot.get_guild(key[0])
+            if guild is None:
+                continue
+            channel_id = int(r[2])
+            member = guild.get_member(key[1])
+            state = member.voice if member is not None else None
+            resumed = (
+                state is not None and state.channel is not None
+                and state.channel.id == channel_id and self._voice_eligible(state)
+            )
+            session = self._voice_sessions.get(key)
+            if session is None:
+                # Ohne Fortsetzung zählt ab jetzt nichts mehr (eligible=False); _sync_voice_sessions
+                # schließt Abwesende dann nur mit dem gesicherten Rest ab bzw. übernimmt den neuen Zustand
+                session = VoiceSession(
+                    guild_id=key[0], user_id=key[1], channel_id=channel_id, since=now, eligible=resumed, member=member
+                )
+                self._voice_sessions[key] = session
+            if resumed:
+                session.since = min(session.since, max(float(r[3]), now - VOICE_SESSION_RESUME_MAX_GAP_SECONDS))
+            session.carry_seconds += float(r[4] or 0)
+        self._sync_voice_sessions()
+        self._voice_ledger_restored = True
+
+    async def _voice_checkpoint(self) -> int:
+        """Rechnet alle offenen Sessions an, schreibt die XP gebündelt und sichert das Ledger."""
+        if not self._voice_ledger_restored:
+            return 0
+        # Nie zwei Checkpoints gleichzeitig: der letzte beim Entladen wartet auf einen laufenden
+        async with self._voice_checkpoint_lock:
+            return await self._write_voice_checkpoint()
+
+    async def _write_voice_checkpoint(self) -> int:
+        now = time.time()
+        for session in self._voice_sessions.values():
+            session.accrue(now)
+            self._queue_voice_award(session, session.take_xp())
+        awards, self._voice_awards = self._voice_awards, {}
+
+        # Gutschrift als Sammel-Upsert in Häppchen à XP_FLUSH_BATCH_SIZE
+        keys = list(awards)
+        for i in range(0, len(keys), XP_FLUSH_BATCH_SIZE):
+            chunk = {key: awards[key] for key in keys[i:i + XP_FLUSH_BATCH_SIZE]}
             try:
-                for vc in guild.voice_channels:
-                    if vc.id == EXCLUDED_VOICE_CHANNEL_ID:
-                        continue
-                    if not vc.members:
-                        continue
-                    for member in vc.members:
-                        if member.bot:
-                            continue
-                        _xp, level, leveled = await self.add_xp(member.id, VOICE_XP_PER_MINUTE)
-                        if leveled:
-                            await self._announce_level_up(guild, member, level)
+                level_ups = await self._write_xp_batch(chunk)
             except Exception as e:
-                print(f"[voice_xp_task] Fehler in Guild {guild.id}: {e}")
+                # Beim nächsten Checkpoint erneut versuchen
+                for key, award in chunk.items():
+                    self._voice_awards.setdefault(key, PendingXP()).merge(award)
+                print(f"[voice_xp_task] Fehler beim Schreiben von {len(chunk)} Mitglied(ern): {e}")
+                continue
+            self._announce_batch_level_ups(chunk, level_ups)
+
+        # Offene Sessions sichern, beendete entfernen
+        closed = [key for key in self._closed_voice_sessions if key not in self._voice_sessions]
+        open_rows = [
+            (s.guild_id, s.user_id, s.channel_id, s.since, s.carry_seconds) for s in self._voice_sessions.values()
+        ]
+        if closed or open_rows:
+            async with self.pool.acquire() as conn:
+                async with conn.cursor() as cur:
+                    if closed:
+                        await cur.executemany("DELETE FROM voice_sessions WHERE guild_id=%s AND user_id=%s", closed)
+                    if open_rows:
+                        await cur.executemany(
+                            "INSERT INTO voice_sessions (guild_id, user_id, channel_id, checkpoint_ts, carry_seconds) "
+                            "VALUES (%s, %s, %s, %s, %s) ON DUPLICATE KEY UPDATE channel_id=VALUES(channel_id), "
+                            "checkpoint_ts=VALUES(checkpoint_ts), carry_seconds=VALUES(carry_seconds)",
+                            open_rows,
+                        )
+            self._closed_voice_sessions.difference_update(closed)
+        return len(awards)
+
+    # -------------------- Voice-XP-Checkpoint --------------------
+    @tasks.loop(seconds=VOICE_XP_TICK_SECONDS)
+    async def voice_xp_task(self):
+        await self.bot.wait_until_ready()
+        started = time.perf_counter()
+        try:
+            # shield: cog_unload bricht den Loop ab, ein laufender Checkpoint schreibt aber zu Ende
+            # (die Gutschriften sind zu diesem Zeitpunkt schon aus _voice_awards genommen)
+            credited = await asyncio.shield(self._voice_checkpoint())
+        except Exception as e:
+            print(f"[voice_xp_task] Fehler beim Checkpoint: {e}")
+            return
+        finally:
+            metrics.observe("discord_task_seconds", time.perf_counter() - started, TASK_BUCKETS, task="voice_xp_task")
+        elapsed = time.perf_counter() - started
+        if credited:
+            print(f"[voice_xp_task] {credited} Mitglied(er) in {elapsed:.3f}s gutgeschrieben")
+        if elapsed > VOICE_XP_TICK_SECONDS:
+            print(f"[voice_xp_task] WARNUNG: Tick dauerte länger als das Intervall ({VOICE_XP_TICK_SECONDS}s)")
 
     @voice_xp_task.before_loop
     async def before_voice_xp_task(self):
         await self.bot.wait_until_ready()
 
+    # -------------------- Write-Behind-Flush --------------------
+    @tasks.loop(seconds=XP_FLUSH_INTERVAL_SECONDS)
+    async def xp_flush_task(self):
+        # shield: ein Abbruch beim Entladen darf keinen schon aus _pending_xp genommenen Batch verwerfen;
+        # der abschließende flush_pending_xp() wartet über _flush_lock, bis er geschrieben ist
+        await asyncio.shield(self.flush_pending_xp())
+
     # -------------------- Rangliste: täglich um 08:00 --------------------
     @tasks.loop(seconds=60)
     async def daily_leaderboard_task(self):
@@ -193,36 +1006,146 @@ class Leveling(commands.Cog):
         if now >= target:
             target += timedelta(days=1)
         await asyncio.sleep((target - now).total_seconds())
+        started = time.perf_counter()
         await self._post_leaderboard_to_all_guilds()
+        metrics.observe("discord_task_seconds", time.perf_counter() - started, TASK_BUCKETS, task="daily_leaderboard_task")
 
     @daily_leaderboard_task.before_loop
     async def before_daily_leaderboard_task(self):
         await self.bot.wait_until_ready()
 
+    # -------------------- Rangliste: Snapshots --------------------
+    @tasks.loop(seconds=LEADERBOARD_CHECKPOINT_SECONDS)
+    async def leaderboard_checkpoint_task(self):
+        try:
+            await self._checkpoint_leaderboard()
+        except Exception as e:
+            print(f"[leaderboard] Snapshot konnte nicht gesichert werden: {e}")
+
+    @leaderboard_checkpoint_task.before_loop
+    async def before_leaderboard_checkpoint_task(self):
+        await self.bot.wait_until_ready()
+
+    async def _checkpoint_leaderboard(self):
+        """Sichert das aktuelle Top-K jeder Guild als Snapshot des heutigen Tages (der letzte Stand des Tages bleibt stehen)."""
+        if not self.top_ks:
+            return
+        today = datetime.now(LEADERBOARD_TIMEZONE).date()
+        rows = [
+            (guild_id, today, pos, uid, total)
+            for guild_id, top_k in self.top_ks.items()
+            for pos, (uid, total) in enumerate(top_k.top(LEADERBOARD_TOP_K), start=1)
+        ]
+        async with self.pool.acquire() as conn:
+            await conn.begin()
+            try:
+                async with conn.cursor() as cur:
+                    await cur.executemany(
+                        "DELETE FROM leaderboard_snapshots WHERE guild_id = %s AND snapshot_date = %s",
+                        [(guild_id, today) for guild_id in self.top_ks],
+                    )
+                    if rows:
+                        await cur.executemany(
+                            "INSERT INTO leaderboard_snapshots (guild_id, snapshot_date, position, user_id, total_xp) "
+                            "VALUES (%s, %s, %s, %s, %s)",
+                            rows,
+                        )
+                    if self.is_primary_cluster:
+                        cutoff = today - timedelta(days=LEADERBOARD_SNAPSHOT_RETENTION_DAYS)
+                        await cur.execute("DELETE FROM leaderboard_snapshots WHERE snapshot_date < %s", (cutoff,))
+                        await cur.execute("DELETE FROM leaderboard_posts WHERE post_date < %s", (cutoff,))
+                await conn.commit()
+            except Exception:
+                await conn.rollback()
+                raise
+
+    async def _get_previous_positions(self, guild_id: int) -> Dict[int, int]:
+        """Platzierungen aus dem letzten Snapshot der Guild vor heute (user_id -> Platz), einmal pro Tag geladen."""
+        today = datetime.now(LEADERBOARD_TIMEZONE).date()
+        cached = self._previous_positions.get(guild_id)
+        if cached is not None and cached[0] == today:
+            return cached[1]
+        async with self.read_pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT user_id, position FROM leaderboard_snapshots WHERE guild_id = %s AND snapshot_date = "
+                    "(SELECT MAX(snapshot_date) FROM leaderboard_snapshots WHERE guild_id = %s AND snapshot_date < %s)",
+                    (guild_id, guild_id, today),
+                )
+                positions = {int(r[0]): int(r[1]) for r in await cur.fetchall()}
+        self._previous_positions[guild_id] = (today, positions)
+        return positions
+
+    async def _leaderboard_top(self, guild_id: int) -> List[Profile]:
+        top_k = await self._get_top_k(guild_id)
+        return [Profile.from_total(guild_id, uid, total) for uid, total in top_k.top(LEADERBOARD_SIZE)]
+
+    @staticmethod
+    def _rank_change_arrow(position: int, previous: Optional[int]) -> str:
+        if previous is None:
+            return "🆕"
+        if previous > position:
+            return f"▲{previous - position}"
+        if previous < position:
+            return f"▼{position - previous}"
+        return "▬"
+
+    async def _claim_daily_post(self, guild_id: int, post_date: date) -> bool:
+        """True genau für den einen Prozess, der den Tagespost dieser Guild als Erster beansprucht."""
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "INSERT IGNORE INTO leaderboard_posts (guild_id, post_date) VALUES (%s, %s)", (guild_id, post_date)
+                )
+                return cur.rowcount == 1
+
+    async def _release_daily_post(self, guild_id: int, post_date: date):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "DELETE FROM leaderboard_posts WHERE guild_id = %s AND post_date = %s", (guild_id, post_date)
+                )
+
     async def _post_leaderboard_to_all_guilds(self):
+        today = datetime.now(LEADERBOARD_TIMEZONE).date()
         for guild in list(self.bot.guilds):
             channel = guild.get_channel(LEVEL_ANNOUNCE_CHANNEL_ID)  # type: ignore
             if isinstance(channel, discord.TextChannel):
+                try:
+                    if not await self._claim_daily_post(guild.id, today):
+                        continue
+                except Exception as e:
+                    print(f"[leaderboard] Tagespost für Guild {guild.id} konnte nicht beansprucht werden: {e}")
+                    continue
                 try:
                     embed = await self._build_leaderboard_embed(guild)
                     if embed:
                         await channel.send(embed=embed)
                 except Exception as e:
                     print(f"[leaderboard] Fehler in Guild {guild.id}: {e}")
+                    # Freigeben, damit ein Neustart am selben Tag es erneut versuchen kann
+                    try:
+                        await self._release_daily_post(guild.id, today)
+                    except Exception:
+                        pass
 
     async def _build_leaderboard_embed(self, guild: discord.Guild) -> Optional[discord.Embed]:
-        top = await self.top_users()
+        top = await self._leaderboard_top(guild.id)
         if not top:
             return None
+        previous = await self._get_previous_positions(guild.id)
+        arrows = [self._rank_change_arrow(i, previous.get(p.user_id)) for i, p in enumerate(top, start=1)]
+        snapshot = tuple((p.user_id, p.total_xp, arrow) for p, arrow in zip(top, arrows))
+        cached = self._leaderboard_embeds.get(guild.id)
+        if cached and cached[0] == snapshot and time.monotonic() - cached[1] < LEADERBOARD_RENDER_CACHE_SECONDS:
+            return cached[2]
+
+        # Mentions brauchen kein Member-Objekt (Member.mention ist ebenfalls nur "<@id>"),
+        # Discord rendert den Namen selbst -> keine Lookups pro Platz
         lines = []
-        for i, p in enumerate(top, start=1):
-            try:
-                member = guild.get_member(p.user_id) or await guild.fetch_member(p.user_id)
-                mtxt = member.mention if member else f"<@{p.user_id}>"
-            except Exception:
-                mtxt = f"<@{p.user_id}>"
-            score = combined_score(p.level, p.xp)
-            lines.append(f"**#{i}** — {mtxt} • Level {p.level} • {p.xp} XP (Gesamt: {score})")
+        for i, (p, arrow) in enumerate(zip(top, arrows), start=1):
+            score = p.total_xp
+            lines.append(f"**#{i}** {arrow} — <@{p.user_id}> • Level {p.level} • {p.xp} XP (Gesamt: {score})")
         embed = discord.Embed(
             title="🏆 Tages-Rangliste",
             description="\n".join(lines),
@@ -230,9 +1153,21 @@ class Leveling(commands.Cog):
             timestamp=datetime.now(tz=LEADERBOARD_TIMEZONE)
         )
         embed.set_footer(text="Nächste Aktualisierung morgen um 08:00")
+        self._leaderboard_embeds[guild.id] = (snapshot, time.monotonic(), embed)
         return embed
 
     # -------------------- Befehle --------------------
+    async def _build_level_embed(self, guild: discord.Guild, target: discord.abc.User) -> discord.Embed:
+        profile = await self.get_profile(guild.id, target.id, read_only=True)
+        rank, count = await self.get_rank(guild.id, profile.total_xp)
+        need = xp_for_next_level(profile.level)
+        embed = discord.Embed(title=f"Level von {target.display_name}", color=discord.Color.blurple())
+        embed.add_field(name="Level", value=str(profile.level))
+        embed.add_field(name="XP", value=f"{profile.xp} / {need}")
+        embed.add_field(name="Rang", value=f"#{rank} von {count}")
+        embed.set_thumbnail(url=target.display_avatar.url)
+        return embed
+
     @app_commands.command(name="level", description="Zeige dein aktuelles Level und den XP-Fortschritt.")
     async def level_slash(self, interaction: discord.Interaction, mitglied: Optional[discord.Member] = None):
         if interaction.channel_id != LEVEL_QUERY_CHANNEL_ID:
@@ -240,13 +1175,10 @@ class Leveling(commands.Cog):
                 f"Bitte benutze diesen Befehl in <#{LEVEL_QUERY_CHANNEL_ID}>.", ephemeral=True
             )
         target = mitglied or interaction.user
-        profile = await self.get_profile(target.id)
-        need = xp_for_next_level(profile.level)
-        embed = discord.Embed(title=f"Level von {target.display_name}", color=discord.Color.blurple())
-        embed.add_field(name="Level", value=str(profile.level))
-        embed.add_field(name="XP", value=f"{profile.xp} / {need}")
-        embed.set_thumbnail(url=target.display_avatar.url)
-        await interaction.response.send_message(embed=embed)
+        # Profil/Rang können die DB brauchen -> nicht am 3-Sekunden-Limit der Interaction hängen
+        await interaction.response.defer(thinking=True)
+        embed = await self._build_level_embed(interaction.guild, target)
+        await interaction.followup.send(embed=embed)
 
     @app_commands.command(name="rangliste", description="Zeigt die aktuelle Rangliste.")
     async def leaderboard_slash(self, interaction: discord.Interaction):
@@ -264,12 +1196,7 @@ class Leveling(commands.Cog):
         if ctx.channel.id != LEVEL_QUERY_CHANNEL_ID:
             return await ctx.reply(f"Bitte benutze diesen Befehl in <#{LEVEL_QUERY_CHANNEL_ID}>.")
         target = member or ctx.author
-        profile = await self.get_profile(target.id)
-        need = xp_for_next_level(profile.level)
-        embed = discord.Embed(title=f"Level von {target.display_name}", color=discord.Color.blurple())
-        embed.add_field(name="Level", value=str(profile.level))
-        embed.add_field(name="XP", value=f"{profile.xp} / {need}")
-        embed.set_thumbnail(url=target.display_avatar.url)
+        embed = await self._build_level_embed(ctx.guild, target)
         await ctx.send(embed=embed)
 
     @commands.hybrid_command(name="rangliste", with_app_command=False)
@@ -282,19 +1209,93 @@ class Leveling(commands.Cog):
         await ctx.send(embed=embed)
 
     # -------------------- Interna --------------------
-    async def _announce_level_up(self, guild: discord.Guild, member: discord.Member, new_level: int):
+    def _announce_level_up(self, guild: discord.Guild, member: discord.Member, new_level: int):
+        """Reiht die Meldung nur ein (blockiert nie); gesendet wird vom Level-Up-Sender."""
         channel: Optional[discord.TextChannel] = guild.get_channel(LEVEL_ANNOUNCE_CHANNEL_ID)  # type: ignore
         if channel is None:
             channel = guild.system_channel  # type: ignore
         if channel:
             try:
-                await channel.send(f"🎉 {member.mention} hat **Level {new_level}** erreicht! Weiter so!")
-            except Exception:
-                pass
+                self._level_up_queue.put_nowait((channel, member, new_level))
+            except asyncio.QueueFull:
+                self.level_ups_dropped += 1
+
+    async def _level_up_sender(self):
+        """Sammelt Level-Ups für LEVEL_UP_COALESCE_SECONDS und sendet pro Kanal eine Nachricht (seriell, rate-limit-schonend)."""
+        loop = asyncio.get_running_loop()
+        while True:
+            item = await self._level_up_queue.get()
+            if item is None:
+                return
+            batch = [item]
+            stopping = False
+            deadline = loop.time() + LEVEL_UP_COALESCE_SECONDS
+            while (remaining := deadline - loop.time()) > 0:
+                try:
+                    item = await asyncio.wait_for(self._level_up_queue.get(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            await self._send_level_ups(batch)
+            if stopping:
+                return
+
+    async def _send_level_ups(self, batch: List[Tuple[discord.abc.Messageable, discord.Member, int]]):
+        by_channel: Dict[int, Tuple[discord.abc.Messageable, Dict[int, Tuple[discord.Member, int]]]] = {}
+        for channel, member, level in batch:
+            _channel, members = by_channel.setdefault(channel.id, (channel, {}))
+            previous = members.get(member.id)
+            if previous is None or previous[1] < level:
+                members[member.id] = (member, level)
+        for channel, members in by_channel.values():
+            entries = list(members.values())
+            for i in range(0, len(entries), LEVEL_UP_MAX_MENTIONS):
+                try:
+                    await channel.send(self._format_level_ups(entries[i:i + LEVEL_UP_MAX_MENTIONS]))
+                except Exception:
+                    pass
+
+    @staticmethod
+    def _format_level_ups(entries: List[Tuple[discord.Member, int]]) -> str:
+        if len(entries) == 1:
+            member, level = entries[0]
+            return f"🎉 {member.mention} hat **Level {level}** erreicht! Weiter so!"
+        names = [f"{member.mention} (Level {level})" for member, level in entries]
+        return f"🎉 {', '.join(names[:-1])} und {names[-1]} haben ein neues Level erreicht! Weiter so!"
 
-    def cog_unload(self):
+    async def cog_unload(self):
         self.voice_xp_task.cancel()
         self.daily_leaderboard_task.cancel()
+        self.leaderboard_checkpoint_task.cancel()
+        self.xp_flush_task.cancel()
+        if self.metric_gauges in metrics.gauge_collectors:
+            metrics.gauge_collectors.remove(self.metric_gauges)
+        # Erst die Queue abarbeiten: deren XP landet so noch im Puffer, der gleich geschrieben wird
+        await self._drain_ingest_queue()
+        # Puffer leeren, damit beim Entladen/Herunterfahren (bot.close) keine XP verloren gehen;
+        # offene Voice-Sessions bleiben gesichert und werden nach dem Neustart fortgesetzt.
+        # Beide warten über ihre Locks auf einen eventuell noch laufenden (abgeschirmten) Durchlauf.
+        await self.flush_pending_xp()
+        await self._voice_checkpoint()
+        await self._checkpoint_leaderboard()
+        # Sender per Sentinel beenden: er sendet seinen aktuellen Batch und alles davor Eingereihte noch ab
+        try:
+            await asyncio.wait_for(self._level_up_queue.put(None), LEVEL_UP_DRAIN_TIMEOUT_SECONDS)
+            await asyncio.wait_for(self._level_up_sender_task, LEVEL_UP_DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            print("[leveling] Level-Up-Meldungen konnten beim Entladen nicht vollständig gesendet werden")
+            self._level_up_sender_task.cancel()
+        # Was danach noch eingereiht wurde, direkt senden
+        remaining = []
+        while not self._level_up_queue.empty():
+            item = self._level_up_queue.get_nowait()
+            if item is not None:
+                remaining.append(item)
+        if remaining:
+            await self._send_level_ups(remaining)
 
 
 async def setup(bot: commands.Bot):
@@ -1,29 +1,62 @@
 # cogs/self_roles.py
+import asyncio
+import hashlib
 import discord
 from discord import app_commands
 from discord.ext import commands
 import os
 import json
 import pathlib
-from typing import Dict, Any, Optional, Tuple
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Dict, Any, List, Optional, Set, Tuple
+from utils.db import InstrumentedPool
+from utils.members import fetch_member, member_cache, resolve_member
+from utils.metrics import metrics
 
+# ------------------------------
+# KONFIGURATION
+# ------------------------------
+ROLE_CHANGE_COALESCE_SECONDS = 1.5  # Reactions eines Mitglieds innerhalb dieses Fensters -> 1 Rollen-Edit
+ROLE_EDITS_PER_GUILD = 4            # max. gleichzeitige Member-Edits pro Guild
+ROLE_STATE_GRACE_SECONDS = 10       # so lange gilt der Rollenstand aus der Edit-Antwort vor dem Gateway-Cache
+PANEL_REFRESH_CONCURRENCY = 4       # gleichzeitige Panel-Edits bei /selfroles_refresh
+RECONCILE_ON_READY = True           # beim (Re-)Connect verpasste Reactions nachziehen
+RECONCILE_REMOVE_UNREACTED = True   # /selfroles_reconcile: Rollenträger ohne Reaction verlieren die Rolle
+RECONCILE_ON_READY_REMOVE = False   # automatischer Abgleich: nur fehlende Rollen vergeben (von Hand vergebene bleiben)
+RECONCILE_BATCH_SIZE = 50           # Korrekturen pro Runde (laufen über das Per-Guild-Limit der Edits)
+RECONCILE_MAX_REACTORS = 100_000    # Speicherdeckel pro Emoji; darüber werden keine Rollen entfernt
+
+# Altbestand: wird beim ersten Start einmalig nach MySQL importiert und danach umbenannt
 DATA_DIR = pathlib.Path("data")
-DATA_DIR.mkdir(exist_ok=True)
 DATA_FILE = DATA_DIR / "selfroles.json"
+IMPORTED_FILE = DATA_DIR / "selfroles.json.imported"
+
+SAVE_FAILED_NOTE = "\n⚠️ Änderung konnte nicht gespeichert werden und geht beim Neustart verloren."
 
 # ------------------------------
 # Persistenz
 # ------------------------------
-def load_data() -> Dict[str, Any]:
-    if DATA_FILE.exists():
-        try:
-            return json.loads(DATA_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            return {}
-    return {}
+def read_legacy_file() -> Optional[Dict[str, Any]]:
+    """
+    Liest die alte selfroles.json (blockierend, nur via asyncio.to_thread aufrufen).
+    None, wenn es keine Datei gibt oder sie nicht lesbar ist.
+    """
+    if not DATA_FILE.exists():
+        return None
+    try:
+        return json.loads(DATA_FILE.read_text(encoding="utf-8"))
+    except Exception as e:
+        print(f"[selfroles] {DATA_FILE} ist nicht lesbar, Import übersprungen: {e}")
+        return None
 
-def save_data(data: Dict[str, Any]) -> None:
-    DATA_FILE.write_text(json.dumps(data, indent=2, ensure_ascii=False), encoding="utf-8")
+@dataclass
+class PendingRoleChange:
+    """Gesammelte Rollenwünsche eines Mitglieds: role_id -> True (hinzufügen) / False (entfernen)."""
+    member: discord.Member
+    changes: Dict[int, bool] = field(default_factory=dict)
+    selectors: Set[str] = field(default_factory=set)
 
 # ------------------------------
 # Emoji Normalisierung / Utils
@@ -56,19 +89,15 @@ def normalize_emoji_from_payload(payload_emoji: discord.PartialEmoji) -> str:
             return f"c:{payload_emoji.id}"
     return f"u:{payload_emoji.name or ''}"
 
-async def resolve_member(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+def normalize_emoji_from_reaction(emoji: Any) -> str:
     """
-    Holt Member zuverlässig: erst Cache, dann API.
+    Wie oben, aber für message.reactions (str, Emoji oder PartialEmoji).
     """
-    member = guild.get_member(user_id)
-    if member is None:
-        try:
-            member = await guild.fetch_member(user_id)
-        except discord.NotFound:
-            return None
-        except discord.HTTPException:
-            return None
-    return member
+    if isinstance(emoji, str):
+        return f"u:{emoji}"
+    if getattr(emoji, "id", None):
+        return f"c:{emoji.id}"
+    return f"u:{emoji.name or ''}"
 
 def can_assign_role(guild: discord.Guild, role: discord.Role) -> bool:
     """
@@ -79,15 +108,6 @@ def can_assign_role(guild: discord.Guild, role: discord.Role) -> bool:
         return False
     return me.top_role > role
 
-async def add_panel_reaction(message: discord.Message, display_emoji: str) -> None:
-    """
-    Fügt der Panel-Message die passende Reaction hinzu (Unicode oder Custom).
-    """
-    try:
-        await message.add_reaction(display_emoji)
-    except discord.HTTPException:
-        pass
-
 # ------------------------------
 # Cog
 # ------------------------------
@@ -110,7 +130,162 @@ class SelfRoles(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         self.guild = discord.Object(id=int(os.getenv("GUILD_ID")))
-        self.data = load_data()
+        self.data: Dict[str, Any] = {}  # Arbeitskopie; Quelle der Wahrheit sind die Tabellen selfrole_*
+        # Abgeleitete Indizes für das Reaction-Dispatching:
+        #   panel_id -> (guild_id, selector name) und (panel_id, emoji_key) -> role_id
+        self._panel_index: Dict[int, Tuple[int, str]] = {}
+        self._role_index: Dict[Tuple[int, str], int] = {}
+        # Rollen-Coalescing: (guild_id, user_id) -> offene Änderungen + wartender Apply-Task
+        self._pending_roles: Dict[Tuple[int, int], PendingRoleChange] = {}
+        self._role_tasks: Dict[Tuple[int, int], asyncio.Task] = {}
+        self._role_edit_limits: Dict[int, asyncio.Semaphore] = {}
+        # Pro Mitglied läuft höchstens ein Edit; neue Wünsche warten in _pending_roles und folgen danach
+        self._role_edits_in_flight: Dict[Tuple[int, int], asyncio.Task] = {}
+        # Rollenstand aus der letzten Edit-Antwort, bis das GUILD_MEMBER_UPDATE im Cache angekommen ist
+        self._edited_members: "OrderedDict[Tuple[int, int], Tuple[float, discord.Member]]" = OrderedDict()
+        self.member_cache = member_cache  # prozessweiter Resolver aus utils.members
+        # panel_id -> Hash des zuletzt gesendeten Embeds (unveränderte Panels werden nicht neu editiert)
+        self._panel_hashes: Dict[int, str] = {}
+        self._reconcile_lock = asyncio.Lock()
+        self._reconcile_task: Optional[asyncio.Task] = None
+
+    @property
+    def pool(self) -> InstrumentedPool:
+        return getattr(self.bot, "db_pool")
+
+    # --------------------------
+    # Persistenz (MySQL)
+    # --------------------------
+    async def _ensure_schema(self):
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS selfrole_selectors (
+                        guild_id BIGINT NOT NULL,
+                        name VARCHAR(100) NOT NULL,
+                        panel_id BIGINT NOT NULL,
+                        channel_id BIGINT NOT NULL,
+                        title VARCHAR(256) NOT NULL DEFAULT '',
+                        description TEXT,
+                        PRIMARY KEY (guild_id, name)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                    """
+                )
+                # seq hält die Bind-Reihenfolge fest (Anzeige + "erste Rolle gewinnt" beim Dispatch)
+                await cur.execute(
+                    """
+                    CREATE TABLE IF NOT EXISTS selfrole_entries (
+                        seq BIGINT NOT NULL AUTO_INCREMENT,
+                        guild_id BIGINT NOT NULL,
+                        selector_name VARCHAR(100) NOT NULL,
+                        role_id BIGINT NOT NULL,
+                        emoji_key VARCHAR(191) NOT NULL,
+                        emoji_display VARCHAR(191) NOT NULL,
+                        PRIMARY KEY (guild_id, selector_name, role_id),
+                        UNIQUE KEY uq_selfrole_entries_seq (seq)
+                    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                    """
+                )
+
+    async def _load_from_db(self) -> Dict[str, Any]:
+        data: Dict[str, Any] = {}
+        async with self.pool.acquire() as conn:
+            async with conn.cursor() as cur:
+                await cur.execute(
+                    "SELECT guild_id, name, panel_id, channel_id, title, description FROM selfrole_selectors"
+                )
+                for gid, name, panel_id, channel_id, title, description in await cur.fetchall():
+                    data.setdefault(str(gid), {"selectors": {}})["selectors"][name] = {
+                        "panel_id": int(panel_id),
+                        "channel_id": int(channel_id),
+                        "title": title or "",
+                        "description": description or "",
+                        "entries": {},
+                    }
+                await cur.execute(
+                    "SELECT guild_id, selector_name, role_id, emoji_key, emoji_display "
+                    "FROM selfrole_entries ORDER BY seq"
+                )
+                for gid, sel_name, role_id, key, display in await cur.fetchall():
+                    conf = data.get(str(gid), {}).get("selectors", {}).get(sel_name)
+                    if conf is not None:
+                        conf["entries"][str(role_id)] = {"key": key, "display": display}
+        return data
+
+    async def _import_legacy_file(self):
+        """Einmaliger Import der alten JSON-Datei; bestehende DB-Zeilen haben Vorrang."""
+        legacy = await asyncio.to_thread(read_legacy_file)
+        if legacy is None:
+            return
+        statements = []
+        for gid, gstore in legacy.items():
+            for name, conf in gstore.get("selectors", {}).items():
+                if conf.get("panel_id") is None:
+                    continue
+                statements.append(self._selector_upsert(int(gid), name, conf, ignore=True))
+                for rid, info in conf.get("entries", {}).items():
+                    statements.append(self._entry_upsert(int(gid), name, int(rid), info, ignore=True))
+        if not await self._persist(statements):
+            return
+        await asyncio.to_thread(DATA_FILE.rename, IMPORTED_FILE)
+        print(f"[selfroles] {len(statements)} Datensätze aus {DATA_FILE} importiert, Datei nach {IMPORTED_FILE} verschoben")
+
+    @staticmethod
+    def _selector_upsert(guild_id: int, name: str, conf: Dict[str, Any], ignore: bool = False) -> Tuple[str, tuple]:
+        args = (guild_id, name, conf["panel_id"], conf["channel_id"], conf.get("title") or "", conf.get("description") or "")
+        if ignore:
+            return (
+                "INSERT IGNORE INTO selfrole_selectors (guild_id, name, panel_id, channel_id, title, description) "
+                "VALUES (%s, %s, %s, %s, %s, %s)",
+                args,
+            )
+        return (
+            "INSERT INTO selfrole_selectors (guild_id, name, panel_id, channel_id, title, description) "
+            "VALUES (%s, %s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE panel_id = VALUES(panel_id), channel_id = VALUES(channel_id), "
+            "title = VALUES(title), description = VALUES(description)",
+            args,
+        )
+
+    @staticmethod
+    def _entry_upsert(guild_id: int, name: str, role_id: int, info: Dict[str, Any], ignore: bool = False) -> Tuple[str, tuple]:
+        args = (guild_id, name, role_id, info.get("key"), info.get("display"))
+        if ignore:
+            return (
+                "INSERT IGNORE INTO selfrole_entries (guild_id, selector_name, role_id, emoji_key, emoji_display) "
+                "VALUES (%s, %s, %s, %s, %s)",
+                args,
+            )
+        return (
+            "INSERT INTO selfrole_entries (guild_id, selector_name, role_id, emoji_key, emoji_display) "
+            "VALUES (%s, %s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE emoji_key = VALUES(emoji_key), emoji_display = VALUES(emoji_display)",
+            args,
+        )
+
+    async def _persist(self, statements: List[Tuple[str, tuple]]) -> bool:
+        """
+        Führt die Statements in einer Transaktion aus (alles oder nichts).
+        Fehler werden geloggt; der Aufrufer bekommt False und kann den Nutzer warnen.
+        """
+        if not statements:
+            return True
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.begin()
+                try:
+                    async with conn.cursor() as cur:
+                        for sql, args in statements:
+                            await cur.execute(sql, args)
+                    await conn.commit()
+                except Exception:
+                    await conn.rollback()
+                    raise
+        except Exception as e:
+            print(f"[selfroles] Speichern fehlgeschlagen: {e}")
+            return False
+        return True
 
     # --------------------------
     # Helpers für Selector-Zugriff
@@ -124,49 +299,86 @@ class SelfRoles(commands.Cog):
     def _get_selector(self, guild: discord.Guild, name: str) -> Optional[Dict[str, Any]]:
         return self._g(guild)["selectors"].get(name)
 
-    def _find_selector_by_message(self, guild: discord.Guild, message_id: int) -> Optional[Tuple[str, Dict[str, Any]]]:
-        for name, sel in self._g(guild)["selectors"].items():
-            if sel.get("panel_id") == message_id:
-                return name, sel
-        return None
+    # --------------------------
+    # Indizes (panel_id / emoji_key)
+    # --------------------------
+    def _rebuild_indexes(self) -> None:
+        self._panel_index.clear()
+        self._role_index.clear()
+        for gid, gstore in self.data.items():
+            for name, conf in gstore.get("selectors", {}).items():
+                self._index_selector(int(gid), name, conf)
+
+    def _index_selector(self, guild_id: int, name: str, conf: Dict[str, Any]) -> None:
+        panel_id = conf.get("panel_id")
+        if panel_id is None:
+            return
+        self._panel_index[panel_id] = (guild_id, name)
+        for rid, info in conf.get("entries", {}).items():
+            # Wie bisher gewinnt bei doppeltem Emoji die zuerst gebundene Rolle
+            self._role_index.setdefault((panel_id, info.get("key")), int(rid))
 
-    async def _refresh_panel_embed(self, guild: discord.Guild, name: Optional[str] = None) -> None:
+    def _unindex_selector(self, conf: Optional[Dict[str, Any]]) -> None:
+        if not conf:
+            return
+        panel_id = conf.get("panel_id")
+        self._panel_index.pop(panel_id, None)
+        for rid, info in conf.get("entries", {}).items():
+            self._role_index.pop((panel_id, info.get("key")), None)
+
+    @staticmethod
+    def _build_panel_embed(sel_name: str, conf: Dict[str, Any]) -> discord.Embed:
+        desc = conf.get("description") or ""
+        entries = conf.get("entries", {})
+        if entries:
+            lines = []
+            for rid, info in entries.items():
+                lines.append(f'{info.get("display", "❓")} → <@&{rid}>')
+            desc = (desc + "\n\n" if desc else "") + "\n".join(lines)
+
+        return discord.Embed(
+            title=conf.get("title") or f"Self-Roles: {sel_name}",
+            description=desc,
+            color=0x5865F2
+        )
+
+    @staticmethod
+    def _embed_hash(embed: discord.Embed) -> str:
+        return hashlib.sha256(json.dumps(embed.to_dict(), sort_keys=True).encode("utf-8")).hexdigest()
+
+    async def _refresh_one_panel(self, guild: discord.Guild, sel_name: str, conf: Dict[str, Any], limit: asyncio.Semaphore) -> str:
+        panel_id = conf.get("panel_id")
+        embed = self._build_panel_embed(sel_name, conf)
+        digest = self._embed_hash(embed)
+        if self._panel_hashes.get(panel_id) == digest:
+            return "unverändert"
+        channel = guild.get_channel(conf.get("channel_id"))
+        if channel is None:
+            return "Channel nicht gefunden"
+
+        # PartialMessage: Edit direkt per ID, ohne vorheriges fetch_message
+        async with limit:
+            try:
+                await channel.get_partial_message(panel_id).edit(embed=embed)
+            except discord.NotFound:
+                return "Panel-Nachricht nicht gefunden"
+            except discord.HTTPException as e:
+                return f"Fehler ({e.status})"
+        self._panel_hashes[panel_id] = digest
+        return "aktualisiert"
+
+    async def _refresh_panel_embed(self, guild: discord.Guild, name: Optional[str] = None) -> Dict[str, str]:
         """
-        Aktualisiert 1 Selector (wenn name gesetzt) oder alle Selector-Embeds.
+        Aktualisiert 1 Selector (wenn name gesetzt) oder alle Selector-Embeds, parallel und begrenzt.
+        Gibt pro Selector das Ergebnis zurück.
         """
         store = self._g(guild)["selectors"]
         items = [(name, store.get(name))] if name else list(store.items())
+        items = [(sel_name, conf) for sel_name, conf in items if conf]
 
-        for sel_name, conf in items:
-            if not conf:
-                continue
-            channel = guild.get_channel(conf.get("channel_id"))
-            if channel is None:
-                continue
-            try:
-                message = await channel.fetch_message(conf.get("panel_id"))
-            except discord.NotFound:
-                continue
-            except discord.HTTPException:
-                continue
-
-            desc = conf.get("description") or ""
-            entries = conf.get("entries", {})
-            if entries:
-                lines = []
-                for rid, info in entries.items():
-                    lines.append(f'{info.get("display", "❓")} → <@&{rid}>')
-                desc = (desc + "\n\n" if desc else "") + "\n".join(lines)
-
-            embed = discord.Embed(
-                title=conf.get("title") or f"Self-Roles: {sel_name}",
-                description=desc,
-                color=0x5865F2
-            )
-            try:
-                await message.edit(embed=embed)
-            except discord.HTTPException:
-                pass
+        limit = asyncio.Semaphore(PANEL_REFRESH_CONCURRENCY)
+        results = await asyncio.gather(*(self._refresh_one_panel(guild, sel_name, conf, limit) for sel_name, conf in items))
+        return {sel_name: result for (sel_name, _conf), result in zip(items, results)}
 
     # --------------------------
     # Slash Commands (Admin only)
@@ -190,10 +402,17 @@ class SelfRoles(commands.Cog):
         gstore = self._g(interaction.guild)
         selectors = gstore["selectors"]
 
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
         # Neu posten (immer neu, damit panel_id aktuell ist)
         embed = discord.Embed(title=title, description=description, color=0x5865F2)
         message = await channel.send(embed=embed)
+        self._panel_hashes[message.id] = self._embed_hash(embed)
 
+        old_conf = selectors.get(name)
+        if old_conf:
+            self._panel_hashes.pop(old_conf.get("panel_id"), None)
+        self._unindex_selector(old_conf)
         selectors[name] = {
             "panel_id": message.id,
             "channel_id": channel.id,
@@ -201,8 +420,11 @@ class SelfRoles(commands.Cog):
             "description": description,
             "entries": selectors.get(name, {}).get("entries", {})  # Falls es schon Einträge gab, beibehalten
         }
-        save_data(self.data)
-        await interaction.response.send_message(f"✅ Selector **{name}** erstellt/aktualisiert.", ephemeral=True)
+        self._index_selector(interaction.guild.id, name, selectors[name])
+        saved = await self._persist([self._selector_upsert(interaction.guild.id, name, selectors[name])])
+        await interaction.followup.send(
+            f"✅ Selector **{name}** erstellt/aktualisiert." + ("" if saved else SAVE_FAILED_NOTE), ephemeral=True
+        )
 
     @app_commands.default_permissions(administrator=True)
     @app_commands.command(name="selfroles_bind", description="Bindet Emoji↔Rolle an einen Selector.")
@@ -221,21 +443,34 @@ class SelfRoles(commands.Cog):
             await interaction.response.send_message("❌ Ich kann diese Rolle nicht verwalten (Hierarchie).", ephemeral=True)
             return
 
+        # Ab hier folgen DB- und REST-Aufrufe -> nicht am 3-Sekunden-Limit der Interaction hängen
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
         key, display = normalize_emoji_from_str(emoji)
+        # Alten Stand aus dem Index nehmen, bevor der Eintrag überschrieben wird (sonst bleibt
+        # beim Umbinden das alte Emoji im Index stehen)
+        self._unindex_selector(conf)
         conf["entries"][str(role.id)] = {"key": key, "display": display}
-        save_data(self.data)
+        self._index_selector(interaction.guild.id, name, conf)
+        saved = await self._persist([self._entry_upsert(interaction.guild.id, name, role.id, conf["entries"][str(role.id)])])
 
         channel = interaction.guild.get_channel(conf["channel_id"])
+        if channel is None:
+            await interaction.followup.send("⚠️ Panel-Channel wurde nicht gefunden. Bitte Selector neu erstellen.", ephemeral=True)
+            return
         try:
-            message = await channel.fetch_message(conf["panel_id"])
+            await channel.get_partial_message(conf["panel_id"]).add_reaction(display)
         except discord.NotFound:
-            await interaction.response.send_message("⚠️ Panel-Nachricht wurde nicht gefunden. Bitte Selector neu erstellen.", ephemeral=True)
+            await interaction.followup.send("⚠️ Panel-Nachricht wurde nicht gefunden. Bitte Selector neu erstellen.", ephemeral=True)
             return
+        except discord.HTTPException:
+            pass
 
-        await add_panel_reaction(message, display)
         await self._refresh_panel_embed(interaction.guild, name=name)
 
-        await interaction.response.send_message(f"✅ {display} ↔ {role.mention} in **{name}** hinzugefügt.", ephemeral=True)
+        await interaction.followup.send(
+            f"✅ {display} ↔ {role.mention} in **{name}** hinzugefügt." + ("" if saved else SAVE_FAILED_NOTE), ephemeral=True
+        )
 
     @app_commands.default_permissions(administrator=True)
     @app_commands.command(name="selfroles_unbind", description="Entfernt Emoji/Rolle aus einem Selector.")
@@ -250,26 +485,39 @@ class SelfRoles(commands.Cog):
             await interaction.response.send_message("❌ Selector nicht gefunden.", ephemeral=True)
             return
 
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        # Alten Stand aus dem Index nehmen, bevor Einträge entfernt werden
+        self._unindex_selector(conf)
         entries = conf.get("entries", {})
-        removed = False
+        removed_ids: List[str] = []
 
         if role and str(role.id) in entries:
             entries.pop(str(role.id), None)
-            removed = True
+            removed_ids.append(str(role.id))
 
         if emoji:
             key_to_remove, _disp = normalize_emoji_from_str(emoji)
             for rid, info in list(entries.items()):
                 if info.get("key") == key_to_remove:
                     entries.pop(rid, None)
-                    removed = True
+                    removed_ids.append(rid)
 
         conf["entries"] = entries
-        save_data(self.data)
+        self._index_selector(interaction.guild.id, name, conf)
+        removed = bool(removed_ids)
+        saved = await self._persist([
+            (
+                "DELETE FROM selfrole_entries WHERE guild_id = %s AND selector_name = %s AND role_id = %s",
+                (interaction.guild.id, name, int(rid)),
+            )
+            for rid in removed_ids
+        ])
         await self._refresh_panel_embed(interaction.guild, name=name)
 
-        await interaction.response.send_message(
-            f"{'✅' if removed else '❌'} {'Zuordnung(en) entfernt' if removed else 'Nichts entfernt'} in **{name}**.",
+        await interaction.followup.send(
+            f"{'✅' if removed else '❌'} {'Zuordnung(en) entfernt' if removed else 'Nichts entfernt'} in **{name}**."
+            + ("" if saved else SAVE_FAILED_NOTE),
             ephemeral=True
         )
 
@@ -310,8 +558,17 @@ class SelfRoles(commands.Cog):
         name="(optional) Name des Selectors – nur diesen aktualisieren"
     )
     async def selfroles_refresh(self, interaction: discord.Interaction, name: Optional[str] = None):
-        await self._refresh_panel_embed(interaction.guild, name=name)
-        await interaction.response.send_message("🔄 Panel(s) aktualisiert.", ephemeral=True)
+        if name and not self._get_selector(interaction.guild, name):
+            await interaction.response.send_message("Selector nicht gefunden.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        results = await self._refresh_panel_embed(interaction.guild, name=name)
+        if not results:
+            await interaction.followup.send("Keine Selector vorhanden.", ephemeral=True)
+            return
+        lines = [f"• **{sel_name}**: {result}" for sel_name, result in results.items()]
+        await interaction.followup.send("🔄 Panel(s) aktualisiert:\n" + "\n".join(lines), ephemeral=True)
 
     @app_commands.default_permissions(administrator=True)
     @app_commands.command(name="selfroles_delete", description="Löscht einen Selector (Panel bleibt unberührt).")
@@ -321,87 +578,406 @@ class SelfRoles(commands.Cog):
     async def selfroles_delete(self, interaction: discord.Interaction, name: str):
         gstore = self._g(interaction.guild)
         if name in gstore["selectors"]:
-            gstore["selectors"].pop(name, None)
-            save_data(self.data)
-            await interaction.response.send_message(f"🗑️ Selector **{name}** gelöscht.", ephemeral=True)
+            removed_conf = gstore["selectors"].pop(name, None)
+            self._panel_hashes.pop(removed_conf.get("panel_id"), None)
+            self._unindex_selector(removed_conf)
+            saved = await self._persist([
+                ("DELETE FROM selfrole_entries WHERE guild_id = %s AND selector_name = %s", (interaction.guild.id, name)),
+                ("DELETE FROM selfrole_selectors WHERE guild_id = %s AND name = %s", (interaction.guild.id, name)),
+            ])
+            await interaction.response.send_message(
+                f"🗑️ Selector **{name}** gelöscht." + ("" if saved else SAVE_FAILED_NOTE), ephemeral=True
+            )
         else:
             await interaction.response.send_message("Selector nicht gefunden.", ephemeral=True)
 
+    @app_commands.default_permissions(administrator=True)
+    @app_commands.command(name="selfroles_reconcile", description="Gleicht Rollen mit den Reactions der Panels ab.")
+    @app_commands.describe(
+        name="(optional) Name des Selectors – nur diesen abgleichen"
+    )
+    async def selfroles_reconcile(self, interaction: discord.Interaction, name: Optional[str] = None):
+        if name and not self._get_selector(interaction.guild, name):
+            await interaction.response.send_message("Selector nicht gefunden.", ephemeral=True)
+            return
+        if self._reconcile_lock.locked():
+            await interaction.response.send_message("⏳ Ein Abgleich läuft bereits.", ephemeral=True)
+            return
+
+        await interaction.response.defer(ephemeral=True, thinking=True)
+        async with self._reconcile_lock:
+            results = await self._reconcile_guild(interaction.guild, name=name)
+        if not results:
+            await interaction.followup.send("Keine Selector vorhanden.", ephemeral=True)
+            return
+        lines = [f"• **{sel_name}**: {result}" for sel_name, result in results.items()]
+        await interaction.followup.send("🔁 Abgleich abgeschlossen:\n" + "\n".join(lines), ephemeral=True)
+
     # --------------------------
-    # Reaction Handling
+    # Abgleich Panels <-> Rollen
     # --------------------------
     @commands.Cog.listener()
-    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
-        if payload.guild_id is None:
-            return
+    async def on_ready(self):
+        # on_ready kommt auch nach Reconnects mit neuer Session -> dort können ebenfalls Events fehlen
+        if RECONCILE_ON_READY and not self._reconcile_lock.locked():
+            self._reconcile_task = asyncio.create_task(self._reconcile_all())
+
+    async def _reconcile_all(self):
+        async with self._reconcile_lock:
+            for guild in self.bot.guilds:
+                if not self._g(guild)["selectors"]:
+                    continue
+                try:
+                    results = await self._reconcile_guild(guild, remove=RECONCILE_ON_READY_REMOVE)
+                except Exception as e:
+                    print(f"[selfroles] Abgleich für {guild} fehlgeschlagen: {e}")
+                    continue
+                print(f"[selfroles] Abgleich {guild}: {results}")
+
+    def _dispatch_roles(self, conf: Dict[str, Any]) -> List[Tuple[int, Dict[str, Any]]]:
+        """(role_id, Eintrag) eines Panels – nur die Rollen, die auch der Dispatch verwendet (bei doppeltem Emoji die erste)."""
+        panel_id = conf.get("panel_id")
+        return [
+            (int(rid), info) for rid, info in conf.get("entries", {}).items()
+            if self._role_index.get((panel_id, info.get("key"))) == int(rid)
+        ]
+
+    @staticmethod
+    async def _fetch_panel(guild: discord.Guild, conf: Dict[str, Any]) -> Tuple[Optional[discord.Message], str]:
+        channel = guild.get_channel(conf.get("channel_id"))
+        if channel is None:
+            return None, "Channel nicht gefunden"
+        try:
+            return await channel.fetch_message(conf.get("panel_id")), ""
+        except discord.NotFound:
+            return None, "Panel-Nachricht nicht gefunden"
+        except discord.HTTPException as e:
+            return None, f"Fehler ({e.status})"
+
+    async def _reconcile_guild(
+        self, guild: discord.Guild, name: Optional[str] = None, remove: bool = RECONCILE_REMOVE_UNREACTED
+    ) -> Dict[str, str]:
+        """
+        Seitenweise über reaction.users() iterieren und fehlende Rollen batchweise vergeben.
+        Entzogen wird (mit `remove`) erst danach, gegen die Reactions *aller* Panels, an die eine Rolle
+        gebunden ist – sonst würde dieselbe Rolle auf zwei Panels bei jedem Abgleich hin- und herspringen.
+        Im Speicher liegt pro Rolle nur die Menge der Reactor-IDs (gedeckelt durch RECONCILE_MAX_REACTORS).
+        """
+        store = self._g(guild)["selectors"]
+        targets = [n for n in ([name] if name else list(store)) if store.get(n)]
+        roles_of = {sel_name: self._dispatch_roles(conf) for sel_name, conf in store.items()}
+        # Für Entzüge auch die übrigen Panels lesen, die eine der Rollen vergeben (dort wird nichts vergeben)
+        target_roles = {role_id for sel_name in targets for role_id, _info in roles_of[sel_name]}
+        scan = list(targets)
+        if remove:
+            scan += [
+                sel_name for sel_name in store
+                if sel_name not in targets and any(role_id in target_roles for role_id, _info in roles_of[sel_name])
+            ]
+
+        added: Dict[str, int] = {sel_name: 0 for sel_name in targets}
+        notes: Dict[str, List[str]] = {sel_name: [] for sel_name in targets}
+        failed: Dict[str, str] = {}
+        reactors: Dict[int, Set[int]] = {}
+        blocked: Dict[int, str] = {}  # role_id -> Grund, warum nichts entfernt wird
+        for sel_name in scan:
+            is_target = sel_name in added
+            message, error = await self._fetch_panel(guild, store[sel_name])
+            if message is None:
+                if is_target:
+                    failed[sel_name] = error
+                for role_id, _info in roles_of[sel_name]:
+                    blocked.setdefault(role_id, f"{sel_name}: {error}")
+                continue
+
+            reactions = {normalize_emoji_from_reaction(r.emoji): r for r in message.reactions}
+            for role_id, info in roles_of[sel_name]:
+                role = guild.get_role(role_id)
+                if role is None or not can_assign_role(guild, role):
+                    continue
+                reaction = reactions.get(info.get("key"))
+                if reaction is None:
+                    # Der Bot setzt jedes Emoji selbst -> fehlt die Reaction ganz, wurde das Panel geleert
+                    # (z.B. "Reaktionen entfernen"); das heißt nicht, dass niemand die Rolle will
+                    blocked.setdefault(role_id, f"Reaction {info.get('display')} fehlt auf {sel_name}")
+                    continue
+                seen = reactors.setdefault(role_id, set())
+                batch: List[Any] = []
+                async for user in reaction.users(limit=None):
+                    if user.bot:
+                        continue
+                    if len(seen) >= RECONCILE_MAX_REACTORS:
+                        blocked.setdefault(role_id, f"{info.get('display')}: >{RECONCILE_MAX_REACTORS} Reactions")
+                        break
+                    seen.add(user.id)
+                    if not is_target or (isinstance(user, discord.Member) and user.get_role(role_id) is not None):
+                        continue
+                    batch.append(user)
+                    if len(batch) >= RECONCILE_BATCH_SIZE:
+                        added[sel_name] += await self._apply_reconcile_batch(guild, batch, role_id, True, sel_name)
+                        batch = []
+                if batch:
+                    added[sel_name] += await self._apply_reconcile_batch(guild, batch, role_id, True, sel_name)
+
+        removed: Dict[str, int] = {sel_name: 0 for sel_name in targets}
+        if remove:
+            done: Set[int] = set()
+            for sel_name in targets:
+                for role_id, _info in roles_of[sel_name]:
+                    if role_id in done or sel_name in failed:
+                        continue
+                    done.add(role_id)
+                    if role_id in blocked:
+                        print(f"[selfroles] {guild}: Rolle {role_id} – {blocked[role_id]}, nichts entfernt")
+                        notes[sel_name].append(f"{blocked[role_id]}, nichts entfernt")
+                        continue
+                    role = guild.get_role(role_id)
+                    if role is None or role_id not in reactors:
+                        continue
+                    # Im schlanken Member-Cache-Modus kennt role.members nur gecachte Mitglieder -> nur dort korrigiert
+                    holders = [m for m in role.members if m.id not in reactors[role_id] and not m.bot]
+                    for i in range(0, len(holders), RECONCILE_BATCH_SIZE):
+                        removed[sel_name] += await self._apply_reconcile_batch(
+                            guild, holders[i:i + RECONCILE_BATCH_SIZE], role_id, False, sel_name
+                        )
+
+        results: Dict[str, str] = {}
+        for sel_name in targets:
+            if sel_name in failed:
+                results[sel_name] = failed[sel_name]
+                continue
+            result = f"+{added[sel_name]} / -{removed[sel_name]}"
+            results[sel_name] = result + (f" ({'; '.join(notes[sel_name])})" if notes[sel_name] else "")
+        return results
+
+    async def _apply_reconcile_batch(self, guild: discord.Guild, users: List[Any], role_id: int, add: bool, sel_name: str) -> int:
+        """
+        Wendet Korrekturen sofort über den Coalescer-Pfad an und wartet darauf (Backpressure).
+        Mitglieder mit offenem Sammelfenster werden übersprungen: ihre Live-Reaction ist neuer.
+        """
+        members: List[Optional[discord.Member]] = list(users)
+        unresolved = [i for i, u in enumerate(members) if not isinstance(u, discord.Member)]
+        if unresolved:
+            # Im schlanken Modus liefert reaction.users() nur Users -> gebündelt auflösen statt je ein fetch_member
+            resolved = await self.member_cache.resolve_many(guild, [members[i].id for i in unresolved])
+            for i in unresolved:
+                members[i] = resolved.get(members[i].id)
+        keys: List[Tuple[int, int]] = []
+        for member in members:
+            if member is None or member.bot:
+                continue
+            if (member.get_role(role_id) is not None) == add:
+                continue
+            key = (guild.id, member.id)
+            if key in self._pending_roles:
+                continue
+            self._pending_roles[key] = PendingRoleChange(member=member, changes={role_id: add}, selectors={sel_name})
+            keys.append(key)
+        await asyncio.gather(*(self._apply_role_changes(key) for key in keys))
+        return len(keys)
+
+    # --------------------------
+    # Reaction Handling
+    # --------------------------
+    def _match_reaction(self, payload: discord.RawReactionActionEvent) -> Optional[Tuple[discord.Guild, str, int]]:
+        """
+        Ordnet eine Reaction per Index zu: (guild, selector name, role_id) oder None.
+        Reactions auf andere Nachrichten (fast der gesamte Traffic) scheitern am ersten dict-Lookup.
+        """
+        indexed = self._panel_index.get(payload.message_id)
+        if indexed is None or indexed[0] != payload.guild_id:
+            return None
+        role_id = self._role_index.get((payload.message_id, normalize_emoji_from_payload(payload.emoji)))
+        if role_id is None:
+            return None
         guild = self.bot.get_guild(payload.guild_id)
         if guild is None:
+            return None
+        return guild, indexed[1], role_id
+
+    @commands.Cog.listener()
+    @metrics.timed("discord_listener_seconds", listener="SelfRoles.on_raw_reaction_add")
+    async def on_raw_reaction_add(self, payload: discord.RawReactionActionEvent):
+        matched = self._match_reaction(payload)
+        if matched is None:
             return
+        guild, sel_name, role_id = matched
 
-        # Welcher Selector?
-        found = self._find_selector_by_message(guild, payload.message_id)
-        if not found:
+        role = guild.get_role(role_id)
+        if role is None or not can_assign_role(guild, role):
             return
-        sel_name, conf = found
 
-        member = await resolve_member(guild, payload.user_id)
+        # Add-Events bringen das Mitglied mit -> kein Lookup nötig, und es landet für spätere Removes im Cache
+        member = payload.member
+        if member is not None:
+            self.member_cache.put(member)
+        else:
+            member = await resolve_member(guild, payload.user_id)
         if member is None or member.bot:
             return
 
-        target_key = normalize_emoji_from_payload(payload.emoji)
-
-        for rid, info in conf.get("entries", {}).items():
-            if info.get("key") == target_key:
-                role = guild.get_role(int(rid))
-                if role is None:
-                    continue
-                if not can_assign_role(guild, role):
-                    continue
-                try:
-                    await member.add_roles(role, reason=f"SelfRole add ({sel_name})")
-                except (discord.Forbidden, discord.HTTPException):
-                    pass
-                break
+        self._queue_role_change(member, role.id, True, sel_name)
 
     @commands.Cog.listener()
+    @metrics.timed("discord_listener_seconds", listener="SelfRoles.on_raw_reaction_remove")
     async def on_raw_reaction_remove(self, payload: discord.RawReactionActionEvent):
-        if payload.guild_id is None:
-            return
-        guild = self.bot.get_guild(payload.guild_id)
-        if guild is None:
+        matched = self._match_reaction(payload)
+        if matched is None:
             return
+        guild, sel_name, role_id = matched
 
-        found = self._find_selector_by_message(guild, payload.message_id)
-        if not found:
+        role = guild.get_role(role_id)
+        if role is None or not can_assign_role(guild, role):
             return
-        sel_name, conf = found
 
         member = await resolve_member(guild, payload.user_id)
         if member is None:
             return
 
-        target_key = normalize_emoji_from_payload(payload.emoji)
+        self._queue_role_change(member, role.id, False, sel_name)
 
-        for rid, info in conf.get("entries", {}).items():
-            if info.get("key") == target_key:
-                role = guild.get_role(int(rid))
-                if role is None:
-                    continue
-                if not can_assign_role(guild, role):
-                    continue
-                try:
-                    await member.remove_roles(role, reason=f"SelfRole remove ({sel_name})")
-                except (discord.Forbidden, discord.HTTPException):
-                    pass
+    # --------------------------
+    # Rollen-Coalescing
+    # --------------------------
+    def _queue_role_change(self, member: discord.Member, role_id: int, add: bool, sel_name: str) -> None:
+        """
+        Merkt sich den letzten Wunsch pro Rolle; gegenläufige Add/Remove-Paare heben sich so auf.
+        Das erste Event eines Mitglieds startet das Sammelfenster.
+        """
+        key = (member.guild.id, member.id)
+        pending = self._pending_roles.get(key)
+        if pending is None:
+            pending = self._pending_roles[key] = PendingRoleChange(member=member)
+        else:
+            pending.member = member
+        pending.changes[role_id] = add
+        pending.selectors.add(sel_name)
+        if key not in self._role_tasks:
+            self._role_tasks[key] = asyncio.create_task(self._apply_role_changes_later(key))
+
+    async def _apply_role_changes_later(self, key: Tuple[int, int]):
+        try:
+            await asyncio.sleep(ROLE_CHANGE_COALESCE_SECONDS)
+        finally:
+            self._role_tasks.pop(key, None)
+        await self._apply_role_changes(key)
+
+    async def _apply_role_changes(self, key: Tuple[int, int]):
+        """
+        Setzt den Netto-Rollenstand mit einem einzigen member.edit(roles=...).
+        Läuft für das Mitglied schon ein Edit, übernimmt dieser die neuen Wünsche direkt im Anschluss –
+        zwei parallele PATCHes mit voller Rollenliste würden sich sonst gegenseitig überschreiben.
+        """
+        if key in self._role_edits_in_flight:
+            return
+        self._role_edits_in_flight[key] = asyncio.current_task()
+        try:
+            while True:
+                pending = self._pending_roles.pop(key, None)
+                if pending is None:
+                    return
+                await self._edit_member_roles(key, pending)
+        finally:
+            self._role_edits_in_flight.pop(key, None)
+
+    async def _known_member(self, key: Tuple[int, int], guild: discord.Guild) -> Optional[discord.Member]:
+        """
+        Neuester bekannter Stand: Edit-Antwort (solange frisch), sonst Gateway-Cache, sonst frisch per API.
+        Für Mitglieder außerhalb des Gateway-Caches (schlanker Modus) kommen keine GUILD_MEMBER_UPDATEs an,
+        eine gecachte Kopie kennt also keine Rollenänderungen von Mods/anderen Bots – die volle
+        Rollenliste im Edit würde diese sonst zurückdrehen.
+        """
+        now = time.monotonic()
+        while self._edited_members:
+            edited_at, _member = next(iter(self._edited_members.values()))
+            if now - edited_at < ROLE_STATE_GRACE_SECONDS:
                 break
+            self._edited_members.popitem(last=False)
+        recent = self._edited_members.get(key)
+        if recent is not None:
+            return recent[1]
+        member = guild.get_member(key[1])
+        if member is None:
+            member = await fetch_member(guild, key[1])
+            if member is not None:
+                self.member_cache.put(member)
+        return member
+
+    async def _edit_member_roles(self, key: Tuple[int, int], pending: PendingRoleChange) -> None:
+        guild = pending.member.guild
+        limit = self._role_edit_limits.get(guild.id)
+        if limit is None:
+            limit = self._role_edit_limits[guild.id] = asyncio.Semaphore(ROLE_EDITS_PER_GUILD)
+
+        async with limit:
+            # Aktuellen Stand erst jetzt lesen: der Cache kann sich während des Fensters geändert haben
+            member = await self._known_member(key, guild)
+            if member is None:
+                return  # nicht mehr in der Guild bzw. nicht abrufbar
+            current = {r.id: r for r in member.roles if not r.is_default()}
+            target = dict(current)
+            for role_id, add in pending.changes.items():
+                if not add:
+                    target.pop(role_id, None)
+                elif role_id not in target:
+                    role = guild.get_role(role_id)
+                    if role is not None:
+                        target[role_id] = role
+            if target.keys() == current.keys():
+                return
+            try:
+                updated = await member.edit(
+                    roles=list(target.values()),
+                    reason=f"SelfRole ({', '.join(sorted(pending.selectors))})",
+                )
+            except (discord.Forbidden, discord.HTTPException) as e:
+                print(f"[selfroles] Rollen für {member} konnten nicht gesetzt werden: {e}")
+                return
+            # Neuen Rollenstand merken, sonst rechnet der nächste Edit mit veralteten Rollen
+            if updated is not None:
+                self.member_cache.put(updated)
+                self._edited_members.pop(key, None)
+                self._edited_members[key] = (time.monotonic(), updated)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before: discord.Member, after: discord.Member):
+        # Gateway hat den Edit nachgezogen -> ab jetzt wieder dem Cache vertrauen
+        recent = self._edited_members.get((after.guild.id, after.id))
+        if recent is not None and {r.id for r in recent[1].roles} == {r.id for r in after.roles}:
+            del self._edited_members[(after.guild.id, after.id)]
+
+    @commands.Cog.listener()
+    async def on_raw_member_remove(self, payload: discord.RawMemberRemoveEvent):
+        self.member_cache.discard(payload.guild_id, payload.user.id)
 
     async def cog_load(self):
+        # Der Pool steht vor dem Laden der Extensions; so sind Daten + Indizes vor dem ersten Event da
+        await self._ensure_schema()
+        await self._import_legacy_file()
+        self.data = await self._load_from_db()
+        self._rebuild_indexes()
+        print(f"[selfroles] {len(self._panel_index)} Panel(s) aus der Datenbank geladen")
+
         self.bot.tree.add_command(self.selfroles_create, guild=self.guild)
         self.bot.tree.add_command(self.selfroles_bind, guild=self.guild)
         self.bot.tree.add_command(self.selfroles_unbind, guild=self.guild)
         self.bot.tree.add_command(self.selfroles_list, guild=self.guild)
         self.bot.tree.add_command(self.selfroles_refresh, guild=self.guild)
         self.bot.tree.add_command(self.selfroles_delete, guild=self.guild)
+        self.bot.tree.add_command(self.selfroles_reconcile, guild=self.guild)
+
+    async def cog_unload(self):
+        if self._reconcile_task is not None:
+            self._reconcile_task.cancel()
+        # Wartende Sammelfenster sofort abschließen, damit keine Reaction verloren geht
+        for task in list(self._role_tasks.values()):
+            task.cancel()
+        self._role_tasks.clear()
+        for key in list(self._pending_roles):
+            await self._apply_role_changes(key)
+        # Laufende Edits arbeiten ihre nachgerückten Wünsche noch ab
+        if self._role_edits_in_flight:
+            await asyncio.gather(*self._role_edits_in_flight.values(), return_exceptions=True)
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(SelfRoles(bot))
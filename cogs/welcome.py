@@ -1,12 +1,15 @@
 import discord
 from discord.ext import commands
 
+from utils.metrics import metrics
+
 class Welcome(commands.Cog):
     def __init__(self, bot):
         self.bot = bot
         self.welcome_channel_id = 1399119245782290474  # dein Willkommens-Channel
 
     @commands.Cog.listener()
+    @metrics.timed("discord_listener_seconds", listener="Welcome.on_member_join")
     async def on_member_join(self, member: discord.Member):
         channel = member.guild.get_channel(self.welcome_channel_id)
         if channel:
@@ -0,0 +1,90 @@
+import os
+import sys
+import time
+import signal
+import subprocess
+from typing import Dict, List
+from dotenv import load_dotenv
+
+# Startet den Bot als mehrere Prozesse ("Cluster"). Jeder Prozess bekommt einen eigenen
+# Shard-Bereich (SHARD_IDS) und baut in app.py seinen eigenen aiomysql-Pool auf.
+# Cluster 0 ist der primäre Cluster und übernimmt die Singleton-Jobs.
+
+load_dotenv()
+CLUSTER_COUNT = int(os.getenv("CLUSTER_COUNT", "2"))
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", str(CLUSTER_COUNT)))
+CLUSTER_START_DELAY_SECONDS = 5.5  # Identify-Limit: Cluster nacheinander hochfahren
+RESTART_DELAY_SECONDS = 10         # Wartezeit, bevor ein abgestürzter Cluster neu gestartet wird
+
+
+def shard_ranges(shard_count: int, cluster_count: int) -> List[List[int]]:
+    """Teilt die Shards in zusammenhängende, möglichst gleich große Bereiche auf."""
+    cluster_count = max(1, min(cluster_count, shard_count))
+    base, extra = divmod(shard_count, cluster_count)
+    ranges, start = [], 0
+    for cluster_id in range(cluster_count):
+        size = base + (1 if cluster_id < extra else 0)
+        ranges.append(list(range(start, start + size)))
+        start += size
+    return ranges
+
+
+def spawn(cluster_id: int, shard_ids: List[int]) -> subprocess.Popen:
+    env = dict(
+        os.environ,
+        SHARDING="1",
+        SHARD_COUNT=str(SHARD_COUNT),
+        SHARD_IDS=",".join(str(i) for i in shard_ids),
+        CLUSTER_ID=str(cluster_id),
+    )
+    print(f"🚀 Cluster {cluster_id}: Shards {shard_ids[0]}–{shard_ids[-1]} von {SHARD_COUNT}")
+    # Eigene Session: Strg+C im Terminal trifft nur den Launcher, der jedem Cluster genau ein SIGINT schickt
+    # (ein zweites SIGINT würde in app.py das saubere Herunterfahren abbrechen)
+    return subprocess.Popen([sys.executable, "app.py"], env=env, start_new_session=True)
+
+
+def main():
+    ranges = shard_ranges(SHARD_COUNT, CLUSTER_COUNT)
+    processes: Dict[int, subprocess.Popen] = {}
+    stopping = False
+
+    def stop(*_):
+        nonlocal stopping
+        stopping = True
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    for cluster_id, shard_ids in enumerate(ranges):
+        if stopping:
+            break
+        processes[cluster_id] = spawn(cluster_id, shard_ids)
+        time.sleep(CLUSTER_START_DELAY_SECONDS)
+
+    died_at: Dict[int, float] = {}
+    while not stopping:
+        for cluster_id, proc in list(processes.items()):
+            if proc.poll() is None:
+                continue
+            # Abgestürzten Cluster nach kurzer Pause mit demselben Shard-Bereich neu starten
+            died_at.setdefault(cluster_id, time.monotonic())
+            if time.monotonic() - died_at[cluster_id] >= RESTART_DELAY_SECONDS:
+                print(f"⚠️  Cluster {cluster_id} beendet (Code {proc.returncode}), Neustart")
+                del died_at[cluster_id]
+                processes[cluster_id] = spawn(cluster_id, ranges[cluster_id])
+        time.sleep(1)
+
+    print("🛑 Stoppe alle Cluster …")
+    # SIGINT statt SIGTERM: app.py beendet dann sauber (Cogs schreiben Puffer in cog_unload weg)
+    for proc in processes.values():
+        if proc.poll() is None:
+            proc.send_signal(signal.SIGINT)
+    for proc in processes.values():
+        try:
+            proc.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+
+if __name__ == "__main__":
+    main()
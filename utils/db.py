@@ -0,0 +1,245 @@
+# utils/db.py
+import asyncio
+import re
+import time
+from contextlib import asynccontextmanager
+from typing import Any, Dict, Optional
+
+import aiomysql
+
+from utils.metrics import Histogram
+
+# ------------------------------
+# KONFIGURATION
+# ------------------------------
+SLOW_LOG_SQL_CHARS = 200  # so viel vom Statement landet im Slow-Query-Log
+
+_LABEL_RE = re.compile(
+    r"^\s*(?:(UPDATE)|(\w+)\b.*?\b(?:FROM|INTO|TABLE(?:\s+IF\s+(?:NOT\s+)?EXISTS)?))\s+`?(\w+)", re.I | re.S
+)
+
+
+def statement_label(sql: str) -> str:
+    """Label für die Statistik aus dem Statement ableiten, z.B. "INSERT member_xp" oder "SELECT voice_sessions"."""
+    match = _LABEL_RE.match(sql)
+    if match:
+        return f"{(match.group(1) or match.group(2)).upper()} {match.group(3)}"
+    return sql.split(None, 1)[0].upper() if sql.strip() else "?"
+
+
+class InstrumentedCursor:
+    """Cursor-Wrapper: misst jede Abfrage, erzwingt das Query-Timeout und loggt langsame Statements."""
+
+    def __init__(self, pool: "InstrumentedPool", conn: aiomysql.Connection, cursor: aiomysql.Cursor):
+        self._pool = pool
+        self._conn = conn
+        self._cursor = cursor
+
+    def __getattr__(self, name: str) -> Any:
+        # fetchone/fetchall/rowcount/lastrowid/... unverändert durchreichen
+        return getattr(self._cursor, name)
+
+    async def execute(self, query: str, args: Any = None, label: Optional[str] = None) -> int:
+        return await self._timed(self._cursor.execute(query, args), query, label)
+
+    async def executemany(self, query: str, args: Any, label: Optional[str] = None) -> int:
+        return await self._timed(self._cursor.executemany(query, args), query, label)
+
+    async def _timed(self, call, query: str, label: Optional[str]) -> int:
+        label = label or statement_label(query)
+        started = time.perf_counter()
+        try:
+            if self._pool.query_timeout:
+                return await asyncio.wait_for(call, self._pool.query_timeout)
+            return await call
+        except asyncio.TimeoutError:
+            # Abgebrochenes Statement lässt die Verbindung in undefiniertem Zustand -> schließen,
+            # der Pool verwirft sie beim Zurückgeben
+            self._conn.close()
+            self._pool.timeouts += 1
+            raise
+        finally:
+            self._pool.record_query(label, time.perf_counter() - started, query)
+
+
+class InstrumentedConnection:
+    def __init__(self, pool: "InstrumentedPool", conn: aiomysql.Connection):
+        self._pool = pool
+        self._conn = conn
+
+    def __getattr__(self, name: str) -> Any:
+        # begin/commit/rollback/... unverändert durchreichen
+        return getattr(self._conn, name)
+
+    @asynccontextmanager
+    async def cursor(self, *cursors):
+        async with self._conn.cursor(*cursors) as cur:
+            yield InstrumentedCursor(self._pool, self._conn, cur)
+
+
+class InstrumentedPool:
+    """
+    Dünner Wrapper um aiomysql.Pool (liegt als bot.db_pool bereit, alle Cogs nutzen ihn unverändert):
+    Wartezeit auf eine Verbindung, Latenz-Histogramme pro Statement-Label, Slow-Query-Log.
+    """
+
+    def __init__(self, pool: aiomysql.Pool, query_timeout: float = 0.0, slow_query_seconds: float = 0.5, name: str = "db"):
+        self.pool = pool
+        self.name = name
+        self.query_timeout = query_timeout
+        self.slow_query_seconds = slow_query_seconds
+        self.acquire_wait = Histogram()
+        self.queries: Dict[str, Histogram] = {}
+        self.slow_queries = 0
+        self.timeouts = 0
+
+    def __getattr__(self, name: str) -> Any:
+        # size/freesize/minsize/maxsize/close/wait_closed/...
+        return getattr(self.pool, name)
+
+    @asynccontextmanager
+    async def acquire(self):
+        started = time.perf_counter()
+        async with self.pool.acquire() as conn:
+            waited = time.perf_counter() - started
+            self.acquire_wait.observe(waited)
+            if waited >= self.slow_query_seconds:
+                print(
+                    f"[{self.name}] {waited * 1000:.0f} ms auf eine Verbindung gewartet "
+                    f"(Pool {self.pool.size}/{self.pool.maxsize}, frei {self.pool.freesize})"
+                )
+            yield InstrumentedConnection(self, conn)
+
+    def record_query(self, label: str, seconds: float, query: str) -> None:
+        histogram = self.queries.get(label)
+        if histogram is None:
+            histogram = self.queries[label] = Histogram()
+        histogram.observe(seconds)
+        if seconds >= self.slow_query_seconds:
+            self.slow_queries += 1
+            sql = " ".join(query.split())[:SLOW_LOG_SQL_CHARS]
+            print(f"[{self.name}] Langsame Abfrage ({label}) {seconds * 1000:.0f} ms: {sql}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "size": self.pool.size,
+            "free": self.pool.freesize,
+            "maxsize": self.pool.maxsize,
+            "acquire_wait_p50_ms": self.acquire_wait.quantile(0.5) * 1000,
+            "acquire_wait_p99_ms": self.acquire_wait.quantile(0.99) * 1000,
+            "slow_queries": self.slow_queries,
+            "timeouts": self.timeouts,
+            "queries": {
+                label: {"count": h.count, "avg_ms": h.sum / h.count * 1000, "p99_ms": h.quantile(0.99) * 1000}
+                for label, h in sorted(self.queries.items())
+            },
+        }
+
+    def metric_histograms(self):
+        """Für utils.metrics: (name, labels, Histogram) der Wartezeit und aller Statement-Labels."""
+        yield "db_acquire_wait_seconds", (("pool", self.name),), self.acquire_wait
+        for label, histogram in self.queries.items():
+            yield "db_query_seconds", (("label", label), ("pool", self.name)), histogram
+
+    def metric_gauges(self):
+        yield "db_pool_connections", (("pool", self.name), ("state", "open")), self.pool.size
+        yield "db_pool_connections", (("pool", self.name), ("state", "free")), self.pool.freesize
+        yield "db_pool_connections", (("pool", self.name), ("state", "max")), self.pool.maxsize
+
+    def format_stats(self) -> str:
+        s = self.stats()
+        busiest = sorted(s["queries"].items(), key=lambda e: e[1]["count"], reverse=True)[:5]
+        top = ", ".join(f"{label}: {q['count']}x ⌀{q['avg_ms']:.1f} ms" for label, q in busiest)
+        return (
+            f"[{self.name}] Pool {s['size']}/{s['maxsize']} (frei {s['free']}), "
+            f"Acquire p50 ≤{s['acquire_wait_p50_ms']:.0f} ms / p99 ≤{s['acquire_wait_p99_ms']:.0f} ms, "
+            f"{s['slow_queries']} langsam, {s['timeouts']} Timeouts | {top}"
+        )
+
+
+class ReplicaPool:
+    """
+    Lese-Pool mit Replica und automatischem Fallback auf den Primary.
+    Die Replica wird nur genutzt, solange sie erreichbar ist und ihr Rückstand <= max_lag Sekunden liegt;
+    ein Hintergrund-Check bewertet das alle check_interval Sekunden neu.
+    """
+
+    def __init__(self, primary: InstrumentedPool, replica: InstrumentedPool, max_lag: float = 5.0, check_interval: float = 15.0):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = False
+        self.lag: Optional[float] = None
+        self.fallbacks = 0
+        self._warned_no_replication = False
+        self._check_task: Optional[asyncio.Task] = None
+
+    async def check(self) -> bool:
+        """Rückstand der Replica prüfen (SHOW REPLICA STATUS, ältere Server: SHOW SLAVE STATUS)."""
+        try:
+            async with self.replica.acquire() as conn:
+                async with conn.cursor(aiomysql.DictCursor) as cur:
+                    try:
+                        await cur.execute("SHOW REPLICA STATUS", label="replica status")
+                    except aiomysql.ProgrammingError:
+                        await cur.execute("SHOW SLAVE STATUS", label="replica status")
+                    row = await cur.fetchone()
+        except Exception as e:
+            self._set_healthy(False, f"nicht erreichbar: {e}")
+            return False
+
+        if not row:
+            # Keine Replikation konfiguriert (z.B. zweite lokale Instanz zum Testen): als aktuell behandeln
+            if not self._warned_no_replication:
+                print(f"[{self.replica.name}] Keine Replikation konfiguriert – Rückstand wird als 0 angenommen")
+                self._warned_no_replication = True
+            self.lag = 0.0
+        else:
+            lag = row.get("Seconds_Behind_Source", row.get("Seconds_Behind_Master"))
+            self.lag = float(lag) if lag is not None else None
+        if self.lag is None:
+            self._set_healthy(False, "Replikation gestoppt")
+        elif self.lag > self.max_lag:
+            self._set_healthy(False, f"Rückstand {self.lag:.0f} s > {self.max_lag:.0f} s")
+        else:
+            self._set_healthy(True)
+        return self.healthy
+
+    def _set_healthy(self, healthy: bool, reason: str = "") -> None:
+        if healthy != self.healthy:
+            state = "aktiv" if healthy else f"deaktiviert ({reason}), Lesezugriffe gehen an den Primary"
+            print(f"[{self.replica.name}] Replica {state}")
+        self.healthy = healthy
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    def start(self) -> None:
+        if self._check_task is None:
+            self._check_task = asyncio.get_running_loop().create_task(self._check_loop())
+
+    @asynccontextmanager
+    async def acquire(self):
+        if self.healthy:
+            acquired = False
+            try:
+                async with self.replica.acquire() as conn:
+                    acquired = True
+                    yield conn
+                return
+            except (aiomysql.OperationalError, aiomysql.InterfaceError, OSError) as e:
+                # Verbindung weg: bis zum nächsten erfolgreichen Check nur noch Primary
+                self._set_healthy(False, f"Verbindungsfehler: {e}")
+                if acquired:
+                    raise
+        self.fallbacks += 1
+        async with self.primary.acquire() as conn:
+            yield conn
+
+    def format_stats(self) -> str:
+        lag = f"{self.lag:.0f} s" if self.lag is not None else "?"
+        state = "aktiv" if self.healthy else "inaktiv"
+        return f"{self.replica.format_stats()} | Replica {state}, Rückstand {lag}, {self.fallbacks} Fallbacks"
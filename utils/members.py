@@ -0,0 +1,149 @@
+# utils/members.py
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+import discord
+
+# ------------------------------
+# KONFIGURATION
+# ------------------------------
+# Im schlanken Modus (LEAN_MEMBER_CACHE=1) ist dieser LRU der einzige Member-Cache außerhalb von Voice.
+MEMBER_CACHE_SIZE = 5000
+MEMBER_CACHE_TTL_SECONDS = 120
+QUERY_MEMBERS_CHUNK = 100  # Discord-Limit für user_ids pro Gateway-Request (REQUEST_GUILD_MEMBERS)
+
+
+async def fetch_member(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+    """
+    Holt ein Mitglied per API (None, wenn es nicht (mehr) in der Guild ist).
+    """
+    try:
+        return await guild.fetch_member(user_id)
+    except discord.NotFound:
+        return None
+    except discord.HTTPException:
+        return None
+
+
+class MemberCache:
+    """
+    Begrenzter LRU-Cache ((guild_id, user_id) -> Member) mit TTL für Mitglieder außerhalb des Gateway-Caches.
+    Gleichzeitige Anfragen für dasselbe Mitglied teilen sich einen einzigen fetch_member-Aufruf.
+    """
+
+    def __init__(self, max_size: int = MEMBER_CACHE_SIZE, ttl: float = MEMBER_CACHE_TTL_SECONDS):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.fetches = 0
+        self.deduplicated = 0
+        self._data: "OrderedDict[Tuple[int, int], Tuple[float, discord.Member]]" = OrderedDict()
+        self._inflight: Dict[Tuple[int, int], asyncio.Future] = {}
+
+    def get(self, guild_id: int, user_id: int) -> Optional[discord.Member]:
+        key = (guild_id, user_id)
+        entry = self._data.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            if entry is not None:
+                del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def put(self, member: discord.Member) -> None:
+        key = (member.guild.id, member.id)
+        self._data[key] = (time.monotonic(), member)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def discard(self, guild_id: int, user_id: int) -> None:
+        self._data.pop((guild_id, user_id), None)
+
+    async def resolve(self, guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+        """Gateway-Cache, dann LRU, dann (dedupliziert) API."""
+        member = guild.get_member(user_id) or self.get(guild.id, user_id)
+        if member is not None:
+            self.hits += 1
+            return member
+        self.misses += 1
+
+        key = (guild.id, user_id)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.deduplicated += 1
+            return await asyncio.shield(inflight)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.fetches += 1
+        member = None
+        try:
+            member = await fetch_member(guild, user_id)
+            if member is not None:
+                self.put(member)
+        finally:
+            # Auch bei Abbruch freigeben: Wartende bekommen dann None statt zu hängen
+            self._inflight.pop(key, None)
+            future.set_result(member)
+        return member
+
+    async def resolve_many(self, guild: discord.Guild, user_ids: Iterable[int]) -> Dict[int, discord.Member]:
+        """
+        Wie resolve, aber für viele Mitglieder: was nicht gecacht ist, kommt gebündelt per
+        query_members(user_ids=...) (ein Gateway-Request je 100 IDs statt eines REST-Fetches pro Mitglied).
+        Fehlende IDs sind nicht (mehr) in der Guild.
+        """
+        found: Dict[int, discord.Member] = {}
+        missing = []
+        for user_id in user_ids:
+            member = guild.get_member(user_id) or self.get(guild.id, user_id)
+            if member is not None:
+                self.hits += 1
+                found[user_id] = member
+            else:
+                self.misses += 1
+                missing.append(user_id)
+        for i in range(0, len(missing), QUERY_MEMBERS_CHUNK):
+            chunk = missing[i:i + QUERY_MEMBERS_CHUNK]
+            self.fetches += 1
+            try:
+                members = await guild.query_members(user_ids=chunk, limit=len(chunk), cache=False)
+            except (asyncio.TimeoutError, discord.ClientException) as e:
+                print(f"[members] query_members für {len(chunk)} Mitglied(er) fehlgeschlagen: {e}")
+                continue
+            for member in members:
+                self.put(member)
+                found[member.id] = member
+        return found
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "fetches": self.fetches,
+            "deduplicated": self.deduplicated,
+        }
+
+    def metric_gauges(self):
+        """Für utils.metrics: Größe sowie Treffer/Fehlgriffe/API-Abrufe seit dem Start."""
+        yield "member_cache_entries", (), len(self._data)
+        yield "member_cache_lookups", (("result", "hit"),), self.hits
+        yield "member_cache_lookups", (("result", "miss"),), self.misses
+        yield "member_cache_fetches", (), self.fetches
+        yield "member_cache_deduplicated", (), self.deduplicated
+
+
+# Ein Resolver pro Prozess (derzeit nur von SelfRoles genutzt), Statistik auf /metrics
+member_cache = MemberCache()
+
+
+async def resolve_member(guild: discord.Guild, user_id: int) -> Optional[discord.Member]:
+    """
+    Holt Member zuverlässig: Gateway-Cache, geteilter LRU, dann API.
+    """
+    return await member_cache.resolve(guild, user_id)
@@ -0,0 +1,198 @@
+# utils/metrics.py
+import asyncio
+import functools
+import time
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+import discord
+from aiohttp import web
+from discord import app_commands
+
+# ------------------------------
+# KONFIGURATION
+# ------------------------------
+# Bucket-Grenzen der Latenz-Histogramme in Sekunden (+Inf kommt implizit dazu)
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+TASK_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+LOOP_LAG_PROBE_SECONDS = 1.0
+
+HELP = {
+    "discord_listener_seconds": "Laufzeit der Event-Listener",
+    "discord_app_command_seconds": "Laufzeit der Slash-Commands",
+    "discord_task_seconds": "Laufzeit der Hintergrund-Tasks pro Durchlauf",
+    "discord_event_loop_lag_seconds": "Verspätung des Event-Loops (periodische Probe)",
+    "discord_gateway_latency_seconds": "Heartbeat-Latenz zum Gateway (bot.latency)",
+    "db_acquire_wait_seconds": "Wartezeit auf eine freie DB-Verbindung",
+    "db_query_seconds": "Laufzeit der DB-Statements pro Label",
+    "db_pool_connections": "Verbindungen im DB-Pool",
+    "member_cache_entries": "Mitglieder im geteilten Member-LRU",
+    "member_cache_lookups": "Lookups im Member-LRU nach Ergebnis seit dem Start",
+    "member_cache_fetches": "API-/Gateway-Abrufe des Member-LRU seit dem Start",
+    "member_cache_deduplicated": "Gleichzeitige Lookups, die einen laufenden Abruf mitgenutzt haben",
+    "leveling_message_processing_seconds": "Verarbeitung einer Nachricht im Ingestion-Worker (Cooldown-Check, XP)",
+    "leveling_ingest_queue_depth": "Nachrichten in der Ingestion-Queue",
+    "leveling_ingest_messages": "Nachrichten nach Ergebnis (eingereiht, verarbeitet, verworfen, ...) seit dem Start",
+    "leveling_level_up_queue_depth": "Level-Up-Meldungen in der Queue",
+    "leveling_level_ups_dropped": "Verworfene Level-Up-Meldungen (volle Queue) seit dem Start",
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+    """Histogramm (Prometheus-Semantik beim Export) mit Summe und Anzahl."""
+
+    def __init__(self, buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts: List[int] = [0] * (len(self.buckets) + 1)  # letzter Eintrag: +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Grobe Schätzung: obere Grenze des Buckets, in dem das Quantil liegt."""
+        if not self.count:
+            return 0.0
+        target, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+def _format_labels(labels: Labels, extra: str = "") -> str:
+    parts = [f'{k}="{v}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_histogram(lines: List[str], name: str, labels: Labels, histogram: Histogram) -> None:
+    cumulative = 0
+    for bound, n in zip(histogram.buckets, histogram.counts):
+        cumulative += n
+        le = 'le="%s"' % bound
+        lines.append(f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+    le = 'le="+Inf"'
+    lines.append(f"{name}_bucket{_format_labels(labels, le)} {histogram.count}")
+    lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+    lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+
+
+class Metrics:
+    """
+    Prozessweite Metriken. Solange enabled False ist, kehrt jede Messung sofort zurück
+    (ein Attribut-Check pro Aufruf), es wird nichts gespeichert.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        # Liefern beim Scrape (name, labels, wert) für Gauges bzw. (name, labels, Histogram)
+        self.gauge_collectors: List[Callable[[], Iterable[Tuple[str, Labels, float]]]] = []
+        self.histogram_collectors: List[Callable[[], Iterable[Tuple[str, Labels, Histogram]]]] = []
+
+    def observe(self, name: str, value: float, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str) -> None:
+        if not self.enabled:
+            return
+        key = tuple(sorted(labels.items()))
+        series = self.histograms.setdefault(name, {})
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        histogram.observe(value)
+
+    def timed(self, name: str, buckets: Sequence[float] = LATENCY_BUCKETS, **labels: str):
+        """Decorator für Coroutinen (Listener, Tasks): misst die Laufzeit jedes Aufrufs."""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return await func(*args, **kwargs)
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - started, buckets, **labels)
+            return wrapper
+        return decorator
+
+    def render(self) -> str:
+        lines: List[str] = []
+        histograms: Dict[str, List[Tuple[Labels, Histogram]]] = {
+            name: list(series.items()) for name, series in self.histograms.items()
+        }
+        for collect in self.histogram_collectors:
+            for name, labels, histogram in collect():
+                histograms.setdefault(name, []).append((labels, histogram))
+        for name, series in sorted(histograms.items()):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} histogram")
+            for labels, histogram in series:
+                render_histogram(lines, name, labels, histogram)
+
+        gauges: Dict[str, List[Tuple[Labels, float]]] = {}
+        for collect in self.gauge_collectors:
+            for name, labels, value in collect():
+                gauges.setdefault(name, []).append((labels, value))
+        for name, series in sorted(gauges.items()):
+            lines.append(f"# HELP {name} {HELP.get(name, name)}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in series:
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+# Eine Instanz pro Prozess; Cogs dekorieren ihre Listener mit metrics.timed(...)
+metrics = Metrics()
+
+
+class MetricsCommandTree(app_commands.CommandTree):
+    """
+    CommandTree mit Laufzeitmessung pro Slash-Command (nur bei aktivierten Metriken installiert).
+    Start in interaction_check, Ende über app_command_completion bzw. on_error.
+    """
+
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras["metrics_started"] = time.perf_counter()
+        return True
+
+    @staticmethod
+    def observe(interaction: discord.Interaction, status: str) -> None:
+        started = interaction.extras.get("metrics_started")
+        if started is None or interaction.type is not discord.InteractionType.application_command:
+            return
+        command = interaction.command
+        name = command.qualified_name if command else str((interaction.data or {}).get("name", "?"))
+        metrics.observe("discord_app_command_seconds", time.perf_counter() - started, command=name, status=status)
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
+        self.observe(interaction, "error")
+        await super().on_error(interaction, error)
+
+
+async def probe_loop_lag(interval: float = LOOP_LAG_PROBE_SECONDS):
+    """Misst, wie viel später als geplant der Loop nach einem sleep(interval) wieder dran ist."""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        metrics.observe("discord_event_loop_lag_seconds", max(0.0, loop.time() - started - interval))
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    async def handle(_request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner